@@ -16,142 +16,230 @@ Credenciales via ENV:
   MB_USER, MB_PASS, OABI_USER, OABI_PASS
 
 Token 2FA via --token (o input interactivo)
+
+Un solo Chromium por proceso (get_or_create_browser); para escalar se crean contextos
+(make_worker), nunca más navegadores: ejecutar() no debe llamar a p.chromium.launch directamente.
 """
 
-import os, re, time, argparse, unicodedata, sys
+import os, re, json, asyncio, argparse, unicodedata, sys, shelve, weakref, logging, multiprocessing
+from datetime import date
 from urllib.parse import urljoin
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 from difflib import get_close_matches
+try:
+    from rapidfuzz import process as rf_process, fuzz as rf_fuzz  # opcional: fuzzy matching en C++
+except ImportError:
+    rf_process = rf_fuzz = None
 import pandas as pd
+from openpyxl import Workbook
 from dotenv import load_dotenv
 
-from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
+from playwright.async_api import async_playwright, TimeoutError as PWTimeout
+
+# Se configura en main() (y en cada proceso de normalización); antes solo salen los avisos
+# (por stderr, vía lastResort)
+log = logging.getLogger("autoapple")
+
+def configurar_logging():
+    # logging en vez de print: formatea solo si el nivel pasa y deja hora por línea
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s", datefmt="%H:%M:%S",
+                        handlers=[logging.StreamHandler(sys.stdout)])
+
+# Con spawn/forkserver cada proceso de normalización reimporta este script: ahí no se repite
+# .env, aviso de credenciales ni lectura del catálogo (llega por el initializer). Se mira el
+# nombre porque parent_process() aún no está fijado mientras el hijo reimporta.
+ES_PROCESO_PRINCIPAL = multiprocessing.current_process().name == "MainProcess"
 
 # ========================= CONFIG =========================
 ARCHIVO_TEMP = "temp_oabi.xlsx"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CATALOGO_MODELOS_XLSX = os.path.join(BASE_DIR, "Modelo Comercial.xlsx")
+CACHE_SCRAPE = os.path.join(BASE_DIR, ".cache", "scrape")  # shelve: "<id>:<fecha>" -> fila normalizada
+HECHOS_OABI = os.path.join(BASE_DIR, ".cache", "oabi_hechos.txt")  # "<id> enviado|confirmado" por línea
 
 MB_BASE_URL = "https://multibanda.com/"  # producción
+MB_PENDIENTES_URL = urljoin(MB_BASE_URL, "index.php?do=submission/pending_adm_submissions_landing_page&rType=page&navbarp=1")
+MB_CONFIRMAR_URL = urljoin(MB_BASE_URL, "index.php?do=submission/confirm_automatic_process&id={id}&rType=page")
 OABI_LOGIN_URL = "https://www.oabi.cl/sistema-oabi/login"
 
-NAV_TIMEOUT = 30_000
+# Sesiones guardadas (cookies + localStorage): si siguen vigentes se omite login y 2FA
+SESION_MB = os.path.join(BASE_DIR, ".cache", "sesion_mb.json")
+SESION_OABI = os.path.join(BASE_DIR, ".cache", "sesion_oabi.json")
+
+# Selectores de login/2FA
+MB_SEL_USUARIO = "#floatingInput"
+MB_SEL_CLAVE = "#floatingPassword"
+MB_SEL_DENTRO = "#tabla-ordenable"  # solo existe con sesión iniciada
+# Bandeja MB: acción dentro de una fila (td[9], el <th> no cuenta) y botón confirmar del modal
+ROW_ACTION_SEL = ":scope > td:nth-of-type(9) > div > a"
+CONFIRM_BTN_SEL = "div.modal.show .modal-footer > button:nth-of-type(2)"
+OABI_SEL_USUARIO = "#username"
+OABI_SEL_CLAVE = "#password"
+OABI_SEL_TOKEN = "#token"
+OABI_SEL_DENTRO = "xpath=/html/body/div[1]/div[1]/ul/li[5]/a"  # menú lateral
+
+# Selectores usados en cada fila; loc() crea su Locator una sola vez por pestaña
+SELECTORES = {
+    # Multibanda: bandeja de pendientes
+    "tabla": MB_SEL_DENTRO,
+    "filas": "#tabla-ordenable > tbody > tr",
+    "buscador": "#buscador",
+    "confirm_btn": CONFIRM_BTN_SEL,
+    "modal": "div.modal.show",
+    # OABI: menú lateral
+    "menu_inscripcion": OABI_SEL_DENTRO,
+    "submenu_inscripcion": "xpath=/html/body/div[1]/div[1]/ul/li[5]/ul/li[1]/a",
+    "nueva_inscripcion": "xpath=/html/body/div[1]/div[2]/div/div/div/div/div/div[2]/div[2]/button",
+}
+
+NAV_TIMEOUT = 30_000  # se fija por contexto (set_default_navigation_timeout)
+# Navegaciones seguidas de una espera explícita de selector no necesitan el evento "load"
+# (imágenes/CSS/subrecursos): basta con el DOM listo
+CARGA_RAPIDA = "domcontentloaded"
 DEF_TIMEOUT = 12_000
 CONTENT_TIMEOUT = 15_000
 
-# Carga .env si existe
-load_dotenv(override=True)
+CONCURRENCIA = 4  # pestañas en paralelo; mantener bajo (sitio + RAM del teléfono)
+CONCURRENCIA_OABI = 4  # pares de pestañas (OABI, MB) procesando filas a la vez
+LOTE_VALIDACION = 32  # filas enviadas a OABI antes de validarlas juntas con una sola lectura del listado
+# Chromium liviano: sin GPU ni imágenes, sin aislamiento por sitio (menos procesos renderer)
+# ni extensiones/traducción; las pestañas en segundo plano no se frenan (hay varias en paralelo)
+CHROMIUM_ARGS = [
+    "--no-sandbox",
+    "--no-zygote",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+    # Chromium solo respeta el último --disable-features: van todas juntas
+    "--disable-features=IsolateOrigins,site-per-process,Translate,BackForwardCache",
+    "--blink-settings=imagesEnabled=false",
+]
+# Solo se bloquea la analítica, y con una ruta acotada a sus hosts: una ruta "**/*" añade un
+# viaje al driver por cada petición y desactiva la caché HTTP del contexto (CSS/JS se volverían
+# a bajar en cada página). Las imágenes ya van apagadas con imagesEnabled=false.
+HOSTS_BLOQUEADOS = ("google-analytics.com", "googletagmanager.com", "doubleclick.net",
+                    "hotjar.com", "clarity.ms", "facebook.net")
+RUTA_BLOQUEADA = re.compile(r"^https?://([^/]*\.)?(%s)(:\d+)?/" % "|".join(map(re.escape, HOSTS_BLOQUEADOS)))
+
+NORMALIZACION_WORKERS = 2  # procesos para normalizar; cada uno carga pandas + catálogo
+
+# Carga .env si existe (los procesos auxiliares heredan el entorno ya cargado)
+if ES_PROCESO_PRINCIPAL:
+    load_dotenv(override=True)
 MB_USER = os.getenv("MB_USER", "")
 MB_PASS = os.getenv("MB_PASS", "")
 OABI_USER = os.getenv("OABI_USER", "")
 OABI_PASS = os.getenv("OABI_PASS", "")
 
-if not (MB_USER and MB_PASS and OABI_USER and OABI_PASS):
-    print("⚠️ Faltan variables de entorno MB_USER/MB_PASS/OABI_USER/OABI_PASS (en .env o exportadas).")
+if ES_PROCESO_PRINCIPAL and not (MB_USER and MB_PASS and OABI_USER and OABI_PASS):
+    log.warning("⚠️ Faltan variables de entorno MB_USER/MB_PASS/OABI_USER/OABI_PASS (en .env o exportadas).")
     # No salimos para permitir ver ayuda/--help; pero fallará al loguear.
 
-KNOWN_BRANDS = {
+# Claves internadas: dict/set comparan por puntero antes que por contenido
+KNOWN_BRANDS = frozenset(sys.intern(x) for x in {
     "APPLE","SAMSUNG","XIAOMI","HUAWEI","MOTOROLA","NOKIA","SONY","OPPO","VIVO",
     "REALME","GOOGLE","ZTE","LG","ONEPLUS","ALCATEL","TECNO","INFINIX","HONOR",
     "BLU","CAT","LENOVO","ASUS","MEIZU","MICROSOFT","BLACKBERRY","PANASONIC",
     "SHARP","TCL","UMIDIGI","ULEFONE","DOOGEE"
-}
+})
 
-BRAND_HINTS = [
+BRAND_HINTS = [(re.compile(p), b) for p, b in (
     (r'(?i)\breno\s*\d', "Oppo"),
     (r'(?i)\bgalaxy\b', "Samsung"),
     (r'(?i)\biphone\b', "Apple"),
     (r'(?i)\bredmi\b', "Xiaomi"),
     (r'(?i)\bmi\s*\d', "Xiaomi"),
     (r'(?i)\bpixel\b', "Google"),
-]
+)]
+
+UNITS = frozenset({"5G","4G","3G","LTE","NR","128","256","512","GB"})
+
+# Regex precompilados (se usan por cada fila normalizada)
+_RE_RENO     = re.compile(r'(?i)\breno\s*(\d+)\b')
+_RE_IPHONE   = re.compile(r'(?i)\biphone\s*(\d+)\b')
+_RE_NONALNUM = re.compile(r'[^A-Z0-9]+')
 
 # ========================= UTILIDADES =========================
-def sleep(s: float): time.sleep(s)
+_ACCENT_TABLE = str.maketrans(
+    "áàäâãéèëêíìïîóòöôõúùüûñçÁÀÄÂÃÉÈËÊÍÌÏÎÓÒÖÔÕÚÙÜÛÑÇ",
+    "aaaaaeeeeiiiiooooouuuuncAAAAAEEEEIIIIOOOOOUUUUNC",
+)
 
+@lru_cache(maxsize=2048)
 def _strip_accents(s: str) -> str:
-    return ''.join(c for c in unicodedata.normalize('NFD', s or "") if unicodedata.category(c) != 'Mn')
+    s = (s or "").translate(_ACCENT_TABLE)
+    if s.isascii():
+        return s
+    # Otros caracteres no latinos: descomposición NFD completa
+    return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
 
+@lru_cache(maxsize=2048)
 def _norm_key(s: str) -> str:
-    s = _strip_accents(s).strip().upper()
-    s = s.replace("|", " ")
-    s = re.sub(r'\s+', ' ', s)
-    return s
+    # split()/join colapsa espacios en C, sin pasar por el motor de regex
+    return " ".join(_strip_accents(s).upper().replace("|", " ").split())
 
-def _pretty_cap(s: str) -> str:
-    s = (s or "").strip()
-    if not s: return s
-    u = _norm_key(s)
-    if u == "APPLE":  return "Apple"
-    if u == "IPHONE": return "iPhone"
+def _apply_case(tokens, units=UNITS) -> str:
     out = []
-    for w in s.split():
-        wu = w.upper()
-        if wu in {"5G","4G","3G","LTE","NR","128","256","512","GB"}:
-            out.append(wu)
-        elif wu == "IPHONE":
+    for w in tokens:
+        up = w.upper()
+        if up in units:
+            out.append(up)
+        elif up == "IPHONE":
             out.append("iPhone")
         elif len(w) <= 2:
-            out.append(wu)
+            out.append(up)
         else:
             out.append(w.capitalize())
     return " ".join(out)
 
+def _pretty_cap(s: str) -> str:
+    s = (s or "").strip()
+    if not s: return s
+    u = _norm_key(s)
+    if u == "APPLE":  return "Apple"
+    if u == "IPHONE": return "iPhone"
+    return _apply_case(s.split())
+
+# Prefijos de marca en un solo regex; "APPLE IPHONE 13" → "13", "SAMSUNG GALAXY A52" → "A52"
+_PREFIX_RE = {
+    "APPLE":   re.compile(r'^(?:APPLE\s+)?(?:IPHONE\s+)?'),
+    "SAMSUNG": re.compile(r'^(?:SAMSUNG GALAXY\s+)?(?:SAMSUNG\s+)?'),
+}
+
+@lru_cache(maxsize=256)
+def _prefijo_marca_re(marca_u: str):
+    return re.compile(rf'^{re.escape(marca_u)}\s+')
+
 def _strip_brand_prefix(modelo_u: str, marca_u: str) -> str:
     t = (modelo_u or "").strip()
     if not t: return t
-    if marca_u == "APPLE":
-        for pref in ("APPLE ", "IPHONE "):
-            if t.startswith(pref): t = t[len(pref):].strip()
-        return t
-    if marca_u == "SAMSUNG":
-        for pref in ("SAMSUNG GALAXY ", "SAMSUNG "):
-            if t.startswith(pref): t = t[len(pref):].strip()
-        return t
-    if t.startswith(marca_u + " "):
-        t = t[len(marca_u) + 1:].strip()
-    return t
-
-def _fix_model_spacing_specific(modelo: str) -> str:
-    s = (modelo or "").strip()
-    s = re.sub(r'(?i)\breno\s*(\d+)\b', r'Reno \1', s)
-    s = re.sub(r'(?i)\biphone\s*(\d+)\b', r'iPhone \1', s)
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
+    pat = _PREFIX_RE.get(marca_u) or _prefijo_marca_re(marca_u)
+    return pat.sub("", t, count=1).strip()
 
 def _finalize_model_case(modelo: str) -> str:
-    s = (modelo or "").strip()
-    s = re.sub(r'(?i)\b(5g|4g|3g|lte|nr|128|256|512|gb)\b', lambda m: m.group(1).upper(), s)
-    words = s.split()
-    fixed = []
-    for w in words:
-        up = w.upper()
-        low = w.lower()
-        if up in {"5G","4G","3G","LTE","NR","128","256","512","GB"}:
-            fixed.append(up)
-        elif low == "iphone":
-            fixed.append("iPhone")
-        elif low == "reno":
-            fixed.append("Reno")
-        else:
-            fixed.append(w.capitalize() if len(w) > 2 else w.upper())
-    return " ".join(fixed)
+    # Una sola pasada: separa "Reno7"/"iPhone13" y aplica mayúsculas por token
+    s = _RE_RENO.sub(r'Reno \1', modelo or "")
+    s = _RE_IPHONE.sub(r'iPhone \1', s)
+    return _apply_case(s.split())
 
 def infer_brand_from_model(modelo_raw: str):
     mk = modelo_raw or ""
     for pat, brand in BRAND_HINTS:
-        if re.search(pat, mk):
+        if pat.search(mk):
             return brand
     return None
 
 # ====== País ======
+@lru_cache(maxsize=2048)
 def _norm_country_key(s: str) -> str:
-    s = _strip_accents(s or "")
-    s = s.upper()
-    s = re.sub(r'[^A-Z0-9]+', ' ', s).strip()
-    s = re.sub(r'\s+', ' ', s)
-    return s
+    # Los espacios también son no alfanuméricos: una sola sustitución ya deja un espacio por tramo
+    return _RE_NONALNUM.sub(' ', _strip_accents(s or "").upper()).strip()
 
-PAIS_MAP = {
+PAIS_MAP = {sys.intern(k): v for k, v in {
     "USA":"Estados Unidos","U S A":"Estados Unidos","US":"Estados Unidos","U S":"Estados Unidos",
     "UNITED STATES":"Estados Unidos","UNITED STATES OF AMERICA":"Estados Unidos","EEUU":"Estados Unidos",
     "EE UU":"Estados Unidos","E E U U":"Estados Unidos","U S OF A":"Estados Unidos",
@@ -183,32 +271,38 @@ PAIS_MAP = {
     "IVORY COAST":"Costa de Marfil","SAUDI ARABIA":"Arabia Saudita","KSA":"Arabia Saudita",
     "UNITED ARAB EMIRATES":"Emiratos Árabes Unidos","UAE":"Emiratos Árabes Unidos","QATAR":"Catar",
     "KUWAIT":"Kuwait","OMAN":"Omán","BAHRAIN":"Baréin","ISRAEL":"Israel","JORDAN":"Jordania","LEBANON":"Líbano",
+}.items()}
+
+# Nombres ya en español (con o sin tildes) → forma canónica
+_ES_MAP = {
+    "Argentina":"Argentina","Bolivia":"Bolivia","Brasil":"Brasil","Canadá":"Canadá","Chile":"Chile",
+    "Colombia":"Colombia","Costa Rica":"Costa Rica","Cuba":"Cuba","Ecuador":"Ecuador","El Salvador":"El Salvador",
+    "España":"España","Estados Unidos":"Estados Unidos","Francia":"Francia","Guatemala":"Guatemala","Honduras":"Honduras",
+    "Italia":"Italia","México":"México","Nicaragua":"Nicaragua","Panamá":"Panamá","Paraguay":"Paraguay",
+    "Perú":"Perú","Portugal":"Portugal","Puerto Rico":"Puerto Rico","Reino Unido":"Reino Unido","República Dominicana":"República Dominicana",
+    "Uruguay":"Uruguay","Venezuela":"Venezuela"
 }
+# Un solo dict para una sola búsqueda; PAIS_MAP tiene prioridad
+_PAIS_LOOKUP = {**{sys.intern(_norm_country_key(k)): v for k, v in _ES_MAP.items()}, **PAIS_MAP}
 
+@lru_cache(maxsize=2048)
 def normalizar_pais(pais_raw: str) -> str:
-    key = _norm_country_key(pais_raw)
-    if key in PAIS_MAP:
-        return PAIS_MAP[key]
-    es = {
-        "Argentina":"Argentina","Bolivia":"Bolivia","Brasil":"Brasil","Canadá":"Canadá","Chile":"Chile",
-        "Colombia":"Colombia","Costa Rica":"Costa Rica","Cuba":"Cuba","Ecuador":"Ecuador","El Salvador":"El Salvador",
-        "España":"España","Estados Unidos":"Estados Unidos","Francia":"Francia","Guatemala":"Guatemala","Honduras":"Honduras",
-        "Italia":"Italia","México":"México","Nicaragua":"Nicaragua","Panamá":"Panamá","Paraguay":"Paraguay",
-        "Perú":"Perú","Portugal":"Portugal","Puerto Rico":"Puerto Rico","Reino Unido":"Reino Unido","República Dominicana":"República Dominicana",
-        "Uruguay":"Uruguay","Venezuela":"Venezuela"
-    }
-    norm_es = { _norm_country_key(k): v for k,v in es.items() }
-    if key in norm_es:
-        return norm_es[key]
-    return _pretty_cap(pais_raw or "Chile")
+    return _PAIS_LOOKUP.get(sys.intern(_norm_country_key(pais_raw))) or _pretty_cap(pais_raw or "Chile")
 
 # ====== Catálogo ======
+def _leer_excel(path_xlsx):
+    # python-calamine (Rust) es bastante más rápido que openpyxl; es opcional
+    try:
+        return pd.read_excel(path_xlsx, sheet_name=0, engine="calamine")
+    except ImportError:
+        return pd.read_excel(path_xlsx, sheet_name=0)
+
 def cargar_catalogo_modelos(path_xlsx):
     try:
-        df = pd.read_excel(path_xlsx, sheet_name=0)
+        df = _leer_excel(path_xlsx)
     except Exception as e:
-        print(f"⚠️ No se pudo leer el catálogo: {e}. Se usarán reglas por defecto.")
-        return {}, {}, {}
+        log.warning("⚠️ No se pudo leer el catálogo: %s. Se usarán reglas por defecto.", e)
+        return {}, {}, {}, {}
 
     cols = {c: _norm_key(c) for c in df.columns}
     inv = {v: k for k, v in cols.items()}
@@ -224,40 +318,63 @@ def cargar_catalogo_modelos(path_xlsx):
     col_modelo_norm = pick("MODELO NORMALIZADO", "MODELO NORMAL", "MODEL NORMALIZED", "MODEL NORM", "MODELO STD")
 
     if not col_marca_raw or not col_modelo_raw:
-        print("⚠️ El catálogo no tiene columnas de marca/modelo reconocibles. Se usarán reglas por defecto.")
-        return {}, {}, {}
+        log.warning("⚠️ El catálogo no tiene columnas de marca/modelo reconocibles. Se usarán reglas por defecto.")
+        return {}, {}, {}, {}
 
     if not col_marca_norm:  col_marca_norm  = col_marca_raw
     if not col_modelo_norm: col_modelo_norm = col_modelo_raw
 
-    exact_map, brand_map, modelos_por_marca = {}, {}, {}
+    exact_map, brand_map, modelos_por_marca, modelos_por_marca_norm = {}, {}, {}, {}
 
-    for _, r in df.iterrows():
-        marca_raw  = _norm_key(str(r.get(col_marca_raw, "")))
-        modelo_raw = _norm_key(str(r.get(col_modelo_raw, "")))
+    # str() por celda como antes: una celda vacía queda "nan" (astype(str) la deja como NaN en pandas 3)
+    columnas = [[str(x) for x in df[c].tolist()] for c in (col_marca_raw, col_modelo_raw, col_marca_norm, col_modelo_norm)]
+    for mr, mor, mn, mon in zip(*columnas):
+        marca_raw  = _norm_key(mr)
+        modelo_raw = _norm_key(mor)
 
-        marca_n    = _pretty_cap(str(r.get(col_marca_norm, "")) or str(r.get(col_marca_raw, "")))
-        modelo_n   = _pretty_cap(str(r.get(col_modelo_norm, "")) or str(r.get(col_modelo_raw, "")))
+        marca_n    = _pretty_cap(mn or mr)
+        modelo_n   = _pretty_cap(mon or mor)
 
         if marca_raw:
             brand_map[marca_raw] = marca_n
         if marca_raw and modelo_raw:
             exact_map[(marca_raw, modelo_raw)] = (marca_n, modelo_n)
-            modelos_por_marca.setdefault(_norm_key(marca_n), set()).add(modelo_n)
+            marca_n_key = _norm_key(marca_n)
+            modelos_por_marca.setdefault(marca_n_key, set()).add(modelo_n)
+            modelos_por_marca_norm.setdefault(marca_n_key, {})[_norm_key(modelo_n)] = modelo_n
 
-    return exact_map, brand_map, modelos_por_marca
+    # Tuplas ordenadas una sola vez: _elegir_modelo_catalogo no vuelve a ordenar por llamada
+    modelos_por_marca = {m: tuple(sorted(v, key=lambda x: (_norm_key(x), x))) for m, v in modelos_por_marca.items()}
+    return exact_map, brand_map, modelos_por_marca, modelos_por_marca_norm
 
-EXACT_MAP, BRAND_MAP, MODELOS_POR_MARCA = cargar_catalogo_modelos(CATALOGO_MODELOS_XLSX)
+# MODELOS_POR_MARCA_NORM: marca normalizada -> {modelo normalizado: modelo original}
+if ES_PROCESO_PRINCIPAL:
+    EXACT_MAP, BRAND_MAP, MODELOS_POR_MARCA, MODELOS_POR_MARCA_NORM = cargar_catalogo_modelos(CATALOGO_MODELOS_XLSX)
+else:
+    EXACT_MAP, BRAND_MAP, MODELOS_POR_MARCA, MODELOS_POR_MARCA_NORM = {}, {}, {}, {}
+
+_ELEGIR_CACHE = {}
 
 def _elegir_modelo_catalogo(marca_norm: str, preferencia: str = "") -> str:
+    key = (marca_norm, preferencia)
+    if key not in _ELEGIR_CACHE:
+        _ELEGIR_CACHE[key] = _elegir_modelo_catalogo_uncached(marca_norm, preferencia)
+    return _ELEGIR_CACHE[key]
+
+def _elegir_modelo_catalogo_uncached(marca_norm: str, preferencia: str = "") -> str:
     marca_u = _norm_key(marca_norm)
-    modelos = sorted(list(MODELOS_POR_MARCA.get(marca_u, set())), key=lambda x: (_norm_key(x)))
+    modelos = MODELOS_POR_MARCA.get(marca_u, ())
     if not modelos:
         return ""
     if preferencia:
-        close = get_close_matches(_pretty_cap(preferencia), modelos, n=1, cutoff=0.80)
-        if close:
-            return close[0]
+        if rf_process is not None:
+            best = rf_process.extractOne(_pretty_cap(preferencia), modelos, scorer=rf_fuzz.ratio, score_cutoff=80)
+            if best:
+                return best[0]
+        else:
+            close = get_close_matches(_pretty_cap(preferencia), modelos, n=1, cutoff=0.80)
+            if close:
+                return close[0]
     modelos_orden = sorted(modelos, key=lambda x: (len(_norm_key(x)), _norm_key(x)))
     return modelos_orden[0] if modelos_orden else ""
 
@@ -265,60 +382,58 @@ def _pareja_en_catalogo(marca_norm: str, modelo_norm: str) -> bool:
     m = _norm_key(marca_norm)
     mo = _norm_key(modelo_norm)
     if not m or not mo: return False
-    return mo in { _norm_key(x) for x in MODELOS_POR_MARCA.get(m, set()) }
+    return mo in MODELOS_POR_MARCA_NORM.get(m, {})
 
+# Memoizada: los mismos pares marca/modelo se repiten en muchas filas
+@lru_cache(maxsize=2048)
 def normalizar_marca_modelo(marca_raw: str, modelo_raw: str):
-    if _norm_key(marca_raw) == "IPHONE":
-        return "Apple", "iPhone"
-
     m_key = _norm_key(marca_raw or "")
+    if m_key == "IPHONE":
+        return "Apple", "iPhone"
     mo_key = _norm_key(modelo_raw or "")
 
     if (m_key, mo_key) in EXACT_MAP:
         m_norm, mo_norm = EXACT_MAP[(m_key, mo_key)]
-        return _pretty_cap(m_norm), _finalize_model_case(_fix_model_spacing_specific(mo_norm))
+        return _pretty_cap(m_norm), _finalize_model_case(mo_norm)
 
     if m_key in BRAND_MAP:
         m_norm = BRAND_MAP[m_key]
         marca_u = _norm_key(m_norm)
         base_modelo = _strip_brand_prefix(mo_key, marca_u)
-        modelos_posibles = MODELOS_POR_MARCA.get(marca_u, set())
+        modelos_posibles = MODELOS_POR_MARCA_NORM.get(marca_u, {})
 
         if marca_u in {"TECNO", "VIVO"}:
             if not base_modelo:
                 if modelos_posibles:
                     elegido = _elegir_modelo_catalogo(m_norm)
-                    print(f"ℹ️ Marca {m_norm} sin modelo → usando catálogo: {elegido}")
-                    return _pretty_cap(m_norm), _finalize_model_case(_fix_model_spacing_specific(elegido))
+                    log.info("ℹ️ Marca %s sin modelo → usando catálogo: %s", m_norm, elegido)
+                    return _pretty_cap(m_norm), _finalize_model_case(elegido)
                 else:
-                    print(f"⚠️ Marca {m_norm} sin modelos en catálogo → usando placeholder")
+                    log.warning("⚠️ Marca %s sin modelos en catálogo → usando placeholder", m_norm)
                     return _pretty_cap(m_norm), "Modelo"
             if not _pareja_en_catalogo(m_norm, base_modelo):
                 elegido = _elegir_modelo_catalogo(m_norm, preferencia=base_modelo) or _elegir_modelo_catalogo(m_norm)
-                print(f"ℹ️ {m_norm} modelo '{base_modelo}' no encontrado → usando '{elegido}' del catálogo")
-                return _pretty_cap(m_norm), _finalize_model_case(_fix_model_spacing_specific(elegido))
-            for mm in modelos_posibles:
-                if _norm_key(mm) == _norm_key(base_modelo):
-                    return _pretty_cap(m_norm), _finalize_model_case(_fix_model_spacing_specific(mm))
+                log.info("ℹ️ %s modelo '%s' no encontrado → usando '%s' del catálogo", m_norm, base_modelo, elegido)
+                return _pretty_cap(m_norm), _finalize_model_case(elegido)
+            return _pretty_cap(m_norm), _finalize_model_case(modelos_posibles[_norm_key(base_modelo)])
 
         if not base_modelo:
             if modelos_posibles:
                 elegido = _elegir_modelo_catalogo(m_norm)
-                print(f"ℹ️ {m_norm} sin modelo → usando '{elegido}' del catálogo")
-                return _pretty_cap(m_norm), _finalize_model_case(_fix_model_spacing_specific(elegido))
+                log.info("ℹ️ %s sin modelo → usando '%s' del catálogo", m_norm, elegido)
+                return _pretty_cap(m_norm), _finalize_model_case(elegido)
             else:
                 return ("Apple", "iPhone") if marca_u == "APPLE" else (_pretty_cap(m_norm), "Modelo")
 
         if modelos_posibles:
-            for mm in modelos_posibles:
-                if _norm_key(mm) == _norm_key(base_modelo):
-                    return _pretty_cap(m_norm), _finalize_model_case(_fix_model_spacing_specific(mm))
+            mm = modelos_posibles.get(_norm_key(base_modelo))
+            if mm:
+                return _pretty_cap(m_norm), _finalize_model_case(mm)
             candidato = _elegir_modelo_catalogo(m_norm, preferencia=base_modelo)
             if candidato:
-                return _pretty_cap(m_norm), _finalize_model_case(_fix_model_spacing_specific(candidato))
+                return _pretty_cap(m_norm), _finalize_model_case(candidato)
 
-        base = _strip_brand_prefix(mo_key, marca_u)
-        mo_norm = _finalize_model_case(_fix_model_spacing_specific(_pretty_cap(base))) if base else ("iPhone" if marca_u == "APPLE" else "Modelo")
+        mo_norm = _finalize_model_case(base_modelo) if base_modelo else ("iPhone" if marca_u == "APPLE" else "Modelo")
         return _pretty_cap(m_norm), mo_norm
 
     inferred = infer_brand_from_model(modelo_raw)
@@ -327,449 +442,1138 @@ def normalizar_marca_modelo(marca_raw: str, modelo_raw: str):
 
     return "Apple", "iPhone"
 
+def _normalize_row(crudo: dict) -> dict:
+    # Función de módulo (picklable) para poder correr en ProcessPoolExecutor
+    marca_norm, modelo_norm = normalizar_marca_modelo(crudo["marca_raw"], crudo["modelo_raw"])
+    pais = normalizar_pais(crudo["pais_raw"])
+    imei_2 = (crudo["imei_2"] or "").strip()
+    cantidad = "2" if imei_2 else "1"
+
+    if _norm_key(marca_norm) in MODELOS_POR_MARCA and not _pareja_en_catalogo(marca_norm, modelo_norm):
+        elegido = _elegir_modelo_catalogo(marca_norm, preferencia=modelo_norm) or _elegir_modelo_catalogo(marca_norm)
+        if elegido:
+            log.info("ℹ️ Ajuste final catálogo: %s '%s' → '%s'", marca_norm, modelo_norm, elegido)
+            modelo_norm = _finalize_model_case(elegido)
+
+    return {
+        "id": crudo["id"],
+        "cantidad_imei": cantidad,
+        "imei_1": crudo["imei_1"],
+        "imei_2": imei_2,
+        "numero_serie": crudo["numero_serie"],
+        "tipo_documento": crudo["tipo_documento"],
+        "numero_documento": crudo["numero_documento"],
+        "marca": marca_norm,
+        "modelo_comercial": modelo_norm,
+        "detalles_tecnicos": "Compra Internacional",
+        "nombre": crudo["nombre"],
+        "pais_origen": pais,
+        "descripcion": "Uso personal"
+    }
+
+def _init_worker_normalizacion(exact_map, brand_map, modelos_por_marca, modelos_por_marca_norm):
+    global EXACT_MAP, BRAND_MAP, MODELOS_POR_MARCA, MODELOS_POR_MARCA_NORM
+    EXACT_MAP, BRAND_MAP, MODELOS_POR_MARCA, MODELOS_POR_MARCA_NORM = exact_map, brand_map, modelos_por_marca, modelos_por_marca_norm
+    configurar_logging()  # con fork ya viene configurado y no hace nada
+
+def crear_pool_normalizacion():
+    # Llamar antes de que exista cualquier hilo (Playwright, to_thread): con fork los procesos se
+    # crean aquí mismo, copiando el catálogo ya cargado sin reimportar el script
+    metodo = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    try:
+        executor = ProcessPoolExecutor(
+            max_workers=min(NORMALIZACION_WORKERS, os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context(metodo),
+            initializer=_init_worker_normalizacion,
+            initargs=(EXACT_MAP, BRAND_MAP, MODELOS_POR_MARCA, MODELOS_POR_MARCA_NORM),
+        )
+    except (NotImplementedError, OSError, ImportError) as e:
+        # Android/Termux puede no tener sem_open: se normaliza en el proceso principal
+        log.info("ℹ️ Sin procesos auxiliares (%s); normalización en el proceso principal.", e)
+        return None
+    try:
+        executor.submit(int).result()  # con fork el primer submit levanta todos los procesos
+    except Exception as e:
+        executor.shutdown()
+        log.info("ℹ️ Sin procesos auxiliares (%s); normalización en el proceso principal.", e)
+        return None
+    return executor
+
+# ====== Excel temporal ======
+def guardar_xlsx(path_xlsx, filas) -> int:
+    # write_only escribe fila a fila sin armar el DataFrame ni el árbol de celdas en memoria;
+    # filas puede ser un generador (ver guardar_xlsx_desde_cache). Devuelve cuántas se escribieron.
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Sheet1")
+    columnas, n = None, 0
+    for f in filas:
+        if columnas is None:
+            columnas = list(f.keys())
+            ws.append(columnas)
+        ws.append([f.get(c, "") for c in columnas])
+        n += 1
+    wb.save(path_xlsx)
+    return n
+
+def guardar_xlsx_desde_cache(path_xlsx, claves) -> int:
+    # Corre en un hilo: abre su propio manejador de solo lectura (dbm.sqlite3 no admite compartir
+    # el del event loop) y va leyendo fila a fila, sin cargar la caché entera en memoria
+    with shelve.open(CACHE_SCRAPE, flag="r") as cache:
+        return guardar_xlsx(path_xlsx, (cache[k] for k in claves if k in cache))
+
 # ========================= PLAYWRIGHT HELPERS =========================
-def wait_invisible_loading(page):
+async def _abortar(route):
+    await route.abort()
+
+async def preparar_contexto(ctx):
+    ctx.set_default_navigation_timeout(NAV_TIMEOUT)
+    await ctx.route(RUTA_BLOQUEADA, _abortar)
+
+_BROWSER = None  # único Chromium del proceso
+
+async def get_or_create_browser(p):
+    global _BROWSER
+    if _BROWSER is None:
+        _BROWSER = await p.chromium.launch(headless=True, args=CHROMIUM_ARGS)  # Cambia a False si quieres ver el navegador (más pesado)
+    return _BROWSER
+
+async def cerrar_browser():
+    global _BROWSER
+    if _BROWSER is not None:
+        await _BROWSER.close()
+        _BROWSER = None
+
+SESIONES = {"mb": SESION_MB, "oabi": SESION_OABI}
+
+async def make_worker(p, rol, usar_sesion=True):
+    # Contexto nuevo (cookies propias) del navegador compartido; rol: "mb" u "oabi"
+    return await nuevo_contexto(await get_or_create_browser(p), SESIONES[rol], usar_sesion=usar_sesion)
+
+async def nuevo_contexto(browser, sesion_path, usar_sesion=True):
+    estado = sesion_path if usar_sesion and os.path.exists(sesion_path) else None
     try:
-        page.wait_for_selector("#mb-loading", state="hidden", timeout=6000)
-    except Exception:
-        pass
+        ctx = await browser.new_context(storage_state=estado)
+    except Exception as e:
+        if estado is None:
+            raise
+        # Archivo truncado/corrupto (p. ej. corte a mitad de escritura): se descarta y se hará login
+        log.warning("⚠️ Sesión guardada ilegible (%s): %s. Se hará login.", os.path.basename(sesion_path), e)
+        os.remove(sesion_path)
+        ctx = await browser.new_context()
+    await preparar_contexto(ctx)
+    return ctx
+
+async def guardar_sesion(ctx, sesion_path):
+    os.makedirs(os.path.dirname(sesion_path), exist_ok=True)
+    # Se escribe a un temporal y se reemplaza: un corte no deja el archivo a medias
+    tmp = sesion_path + ".tmp"
+    await ctx.storage_state(path=tmp)
+    os.chmod(tmp, 0o600)  # contiene cookies de sesión
+    os.replace(tmp, sesion_path)
+
+async def sesion_vigente(page, url, sel_login, sel_dentro) -> bool:
+    # Sin sesión el sitio redirige al formulario; con sesión aparece el contenido
+    await page.goto(url, wait_until=CARGA_RAPIDA)
+    login = page.locator(sel_login)
     try:
-        page.wait_for_selector(".modal-backdrop", state="hidden", timeout=4000)
-    except Exception:
-        pass
+        await login.or_(page.locator(sel_dentro)).first.wait_for(state="attached", timeout=DEF_TIMEOUT)
+    except PWTimeout:
+        return False
+    return await login.count() == 0
 
-def robust_click(page, selector, timeout=12000):
+async def esperar_condicion(page, js, arg=None, timeout=1500) -> bool:
+    # Espera la condición real del DOM en vez de un sleep fijo; si no llega, se sigue igual
     try:
-        page.wait_for_selector(selector, timeout=timeout)
-        page.locator(selector).scroll_into_view_if_needed()
-        page.click(selector, timeout=timeout)
+        await page.wait_for_function(js, arg=arg, timeout=timeout)
         return True
-    except Exception:
+    except PWTimeout:
         return False
 
-def get_input_value(page, selectors):
-    for sel in selectors:
+# Condiciones de DOM usadas en lugar de sleeps
+HAY_FILAS_JS = "(sel) => document.querySelector(sel) !== null"
+# Modelos cargados para la marca elegida: el select de modelo (el que valida
+# cert_new_model_dropdown-error) habilitado y con opciones reales; texto: una opción esperada
+MODELOS_LISTOS_JS = """(texto) => {
+    const s = document.querySelector('#cert_new_model_dropdown');
+    if (!s || s.disabled) return false;
+    if (s.tagName !== 'SELECT') return true;
+    const t = (texto || '').toLowerCase();
+    return [...s.options].some(o => o.value && o.text.toLowerCase().includes(t));
+}"""
+DROPDOWN_CERRADO_JS = "() => document.querySelector('.dropdown-menu.show') === null"
+# Resultado de la búsqueda en cuanto hay filas: 'si'/'no' (ambos cortan la espera); false = aún no hay
+FILA_CON_TEXTO_JS = """([sel, textos]) => {
+    const filas = Array.from(document.querySelectorAll(sel));
+    if (!filas.length) return false;
+    return filas.some(tr => textos.some(t => t && tr.innerText.includes(t))) ? 'si' : 'no';
+}"""
+SOLO_FILA_ID_JS = """(id) => {
+    const f = document.querySelectorAll('#tabla-ordenable tbody tr');
+    return f.length === 1 && (f[0].querySelector('th')?.innerText || '').trim() === id;
+}"""
+
+async def wait_invisible_loading(page, aparecer=0):
+    # aparecer > 0: tras un submit, espera a que el spinner aparezca antes de esperar que se oculte
+    if aparecer:
         try:
-            el = page.locator(sel)
-            if el.count() > 0:
-                v = el.input_value(timeout=2000)
-                if v is not None:
-                    v = v.strip()
-                    if v:
-                        return v
+            await page.wait_for_selector("#mb-loading", state="visible", timeout=aparecer)
         except Exception:
-            continue
-    return ""
-
-def _inner_text(page, sel):
+            pass
     try:
-        return page.locator(sel).inner_text(timeout=2000).strip()
+        await page.wait_for_selector("#mb-loading", state="hidden", timeout=6000)
     except Exception:
-        return ""
-
-def leer_tipo_documento(page):
-    # select#form_document_type si existe
+        pass
     try:
-        if page.locator("#form_document_type").count() > 0:
-            txt = page.locator("#form_document_type option:checked").inner_text(timeout=2000).strip()
-            n = _norm_key(txt)
-            if "PASAP" in n: return "Pasaporte"
-            if "RUT" in n or "DNI" in n: return "RUT (DNI)"
+        await page.wait_for_selector(".modal-backdrop", state="hidden", timeout=4000)
     except Exception:
         pass
-    # fallback por valor/texto
+
+_LOCATORS = weakref.WeakKeyDictionary()  # pestaña -> {clave: Locator}
+
+def loc(page, clave):
+    por_pagina = _LOCATORS.get(page)
+    if por_pagina is None:
+        por_pagina = _LOCATORS[page] = {}
+    l = por_pagina.get(clave)
+    if l is None:
+        l = por_pagina[clave] = page.locator(SELECTORES[clave])
+    return l
+
+async def robust_click(page, selector, timeout=12000, no_wait_after=False):
+    # selector: string o Locator (ver loc()); como page.click, actúa sobre la primera coincidencia.
+    # no_wait_after=True para clics que no navegan (menús, dropdowns, modales): el llamador
+    # espera luego la condición concreta en vez de la espera genérica post-clic de Playwright.
+    l = (page.locator(selector) if isinstance(selector, str) else selector).first
     try:
-        val = page.locator("#form_document_type").input_value(timeout=1500).strip()
-        if val:
-            n = _norm_key(val)
-            if "PASAP" in n: return "Pasaporte"
-            if "RUT" in n or "DNI" in n: return "RUT (DNI)"
+        await l.wait_for(timeout=timeout)
+        await l.scroll_into_view_if_needed()
+        await l.click(timeout=timeout, no_wait_after=no_wait_after)
+        return True
     except Exception:
-        pass
-    txt = _inner_text(page, "#form_document_type")
-    n = _norm_key(txt)
-    if "PASAP" in n: return "Pasaporte"
-    if "RUT" in n or "DNI" in n: return "RUT (DNI)"
-    return "Pasaporte"
+        return False
 
-def leer_pais(page):
-    for sel in [
-        '//*[@id="formulario"]/div[1]/div/div/div[3]/div[10]/div/div/p/b',
-        "//form[@id='formulario']//p//b"
-    ]:
-        try:
-            el = page.locator(sel)
-            if el.count() > 0:
-                t = el.first.inner_text(timeout=1500).strip()
-                if t:
-                    return t
-        except Exception:
-            continue
-    return "Chile"
+# Lee todos los campos de la página de confirmación MB en un solo round-trip (page.evaluate).
+# Cada campo es una lista de selectores (XPath si empieza con "/", si no CSS); gana el primero no vacío.
+EXTRAER_SPEC = {
+    "valores": {
+        "imei_1": ['//input[@type="text" and @value][contains(@id,"imei")][1]',
+                   '/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[2]/div/div/input'],
+        "imei_2": ['/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[3]/div/div/input'],
+        "numero_serie": ['/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[4]/div/div/input'],
+        "numero_documento": ['/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[6]/div/div/input'],
+        "nombre": ['/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[7]/div/div/input',
+                   "//input[contains(@id,'name') or contains(@name,'name')]",
+                   "input[name*='name'], input[id*='name']"],
+    },
+    "textos": {
+        "marca_raw": ['//*[@id="formulario"]/div[1]/div/div/div[3]/div[8]/div/div/p/b'],
+        "modelo_raw": ['//*[@id="formulario"]/div[1]/div/div/div[3]/div[9]/div/div/p/b'],
+        "pais_raw": ['//*[@id="formulario"]/div[1]/div/div/div[3]/div[10]/div/div/p/b',
+                     "//form[@id='formulario']//p//b"],
+    },
+}
 
-def model_error_present(page):
+EXTRAER_JS = """
+(spec) => {
+  const nodo = (sel) => {
+    try {
+      if (sel.startsWith('/')) {
+        return document.evaluate(sel, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+      }
+      return document.querySelector(sel);
+    } catch (e) { return null; }
+  };
+  const primero = (sels, leer) => {
+    for (const sel of sels) {
+      const v = (leer(nodo(sel)) || '').trim();
+      if (v) return v;
+    }
+    return '';
+  };
+  const out = {};
+  for (const [k, sels] of Object.entries(spec.valores)) out[k] = primero(sels, (el) => el?.value);
+  for (const [k, sels] of Object.entries(spec.textos)) out[k] = primero(sels, (el) => el?.innerText);
+  const doc = document.querySelector('#form_document_type');
+  out.tipo_documento = doc
+    ? [doc.querySelector('option:checked')?.innerText || '', doc.value || '', doc.innerText || '']
+    : [];
+  return out;
+}
+"""
+
+def _tipo_documento_desde(textos):
+    # Orden: opción seleccionada, valor, texto completo del select
+    for txt in textos:
+        n = _norm_key(txt)
+        if "PASAP" in n: return "Pasaporte"
+        if "RUT" in n or "DNI" in n: return "RUT (DNI)"
+    return "Pasaporte"
+
+async def model_error_present(page):
     try:
         el = page.locator('//*[@id="cert_new_model_dropdown-error"]')
-        if el.count() > 0:
-            txt = el.inner_text(timeout=1500).strip().lower()
+        if await el.count() > 0:
+            txt = (await el.inner_text(timeout=1500)).strip().lower()
             return ("obligatorio" in txt) or ("requerido" in txt) or ("required" in txt)
     except Exception:
         pass
     return False
 
-def forzar_marca_modelo_generico(page):
+# Fija el valor del campo con foco en un solo round-trip (en vez de una tecla por carácter)
+# y dispara input/change para que el dropdown (select2/bootstrap) filtre igual que al teclear.
+ESCRIBIR_EN_FOCO_JS = """
+(texto) => {
+  const el = document.activeElement;
+  if (!el) return false;
+  if (el.tagName === 'SELECT') {
+    const t = texto.trim().toLowerCase();
+    const opts = [...el.options];
+    const opt = opts.find(o => o.text.trim().toLowerCase() === t) || opts.find(o => o.text.toLowerCase().includes(t));
+    if (!opt) return false;
+    el.value = opt.value;
+  } else if (el.tagName === 'INPUT' || el.tagName === 'TEXTAREA') {
+    el.value = texto;
+  } else {
+    return false;
+  }
+  el.dispatchEvent(new Event('input', {bubbles: true}));
+  el.dispatchEvent(new Event('change', {bubbles: true}));
+  if (window.jQuery) window.jQuery(el).trigger('change.select2');
+  return true;
+}
+"""
+
+async def escribir_en_foco(page, texto):
+    # Si el foco no está en un campo editable (p. ej. botón de bootstrap-select), se teclea como antes
+    if not await page.evaluate(ESCRIBIR_EN_FOCO_JS, texto):
+        await page.keyboard.type(texto)
+
+async def forzar_marca_modelo_generico(page):
     # Simula TAB + escribir Apple + ENTER + TAB + iPhone + ENTER + TAB
-    page.keyboard.press("Shift+Tab")
-    sleep(0.2)
-    page.keyboard.type("Apple")
-    page.keyboard.press("Enter")
-    page.keyboard.press("Tab")
-    sleep(0.2)
-    page.keyboard.type("iPhone")
-    page.keyboard.press("Enter")
-    page.keyboard.press("Tab")
-    sleep(0.2)
+    await page.keyboard.press("Shift+Tab")
+    await escribir_en_foco(page, "Apple")
+    await page.keyboard.press("Enter")
+    await page.keyboard.press("Tab")
+    # Las opciones de la marca anterior siguen ahí hasta que carguen las de Apple
+    await esperar_condicion(page, MODELOS_LISTOS_JS, "iphone", timeout=3000)
+    await escribir_en_foco(page, "iPhone")
+    await page.keyboard.press("Enter")
+    await page.keyboard.press("Tab")
+    await esperar_condicion(page, DROPDOWN_CERRADO_JS, timeout=200)
 
 # ========================= FLUJO =========================
-def login_multibanda(page):
-    page.goto(MB_BASE_URL, timeout=NAV_TIMEOUT)
-    page.fill("#floatingInput", MB_USER, timeout=DEF_TIMEOUT)
-    page.fill("#floatingPassword", MB_PASS, timeout=DEF_TIMEOUT)
-    page.keyboard.press("Enter")
-    page.wait_for_url(re.compile(r"index\.php"), timeout=NAV_TIMEOUT)
-    page.goto(urljoin(MB_BASE_URL, "index.php?do=submission/pending_adm_submissions_landing_page&rType=page&navbarp=1"), timeout=NAV_TIMEOUT)
-
-def obtener_ids_validos(page):
-    page.wait_for_selector("#tabla-ordenable", timeout=NAV_TIMEOUT)
-    sleep(1.5)
-    filas = page.locator("//table[@id='tabla-ordenable']/tbody/tr")
-    total = filas.count()
-    print(f"🔍 Revisando {total} filas...")
+async def login_multibanda(page, con_sesion=True):
+    # con_sesion=False: el contexto partió sin sesión guardada, no hay nada que sondear
+    if con_sesion and await sesion_vigente(page, MB_PENDIENTES_URL, MB_SEL_USUARIO, MB_SEL_DENTRO):
+        log.info("🔓 Sesión de Multibanda vigente, se omite login.")
+        return
+    await page.goto(MB_BASE_URL, wait_until=CARGA_RAPIDA)
+    await page.fill(MB_SEL_USUARIO, MB_USER, timeout=DEF_TIMEOUT)
+    await page.fill(MB_SEL_CLAVE, MB_PASS, timeout=DEF_TIMEOUT)
+    await page.keyboard.press("Enter")
+    await page.wait_for_url(re.compile(r"index\.php"))
+    await guardar_sesion(page.context, SESION_MB)
+    await page.goto(MB_PENDIENTES_URL, wait_until=CARGA_RAPIDA)
+
+FILAS_IDS_JS = """els => els.map(tr => [
+    tr.querySelector(':scope > th')?.innerText || '',
+    tr.querySelector(':scope > td:nth-of-type(9) > div > a')?.innerText || '',
+])"""
+
+async def obtener_ids_validos(page):
+    await loc(page, "tabla").wait_for(state="attached", timeout=NAV_TIMEOUT)
+    await esperar_condicion(page, HAY_FILAS_JS, "#tabla-ordenable tbody tr")
+    # Todas las filas en un solo round-trip; td:nth-of-type(9) = ./td[9] (el <th> no cuenta)
+    filas = await loc(page, "filas").evaluate_all(FILAS_IDS_JS)
+    log.info("🔍 Revisando %s filas...", len(filas))
     ids = []
-    for i in range(total):
-        fila = filas.nth(i)
-        try:
-            boton = fila.locator("./td[9]/div/a")
-            if boton.count() == 0:
-                continue
-            if "Confirmar en OABI" in boton.inner_text(timeout=1500):
-                id_texto = fila.locator("./th").inner_text(timeout=1500).strip()
-                if id_texto.isdigit():
-                    ids.append(id_texto)
-                    print(f"✅ ID válido: {id_texto}")
-        except Exception:
-            continue
-    print(f"🔎 Total IDs con botón Confirmar en OABI: {len(ids)}")
+    for id_texto, boton in filas:
+        id_texto = id_texto.strip()
+        if "Confirmar en OABI" in boton and id_texto.isdigit():
+            ids.append(id_texto)
+            log.info("✅ ID válido: %s", id_texto)
+    log.info("🔎 Total IDs con botón Confirmar en OABI: %s", len(ids))
     return ids
 
-def extraer_y_normalizar_datos(page, ids_validos):
-    datos = []
-    for id_multibanda in ids_validos:
-        try:
-            confirm_url = urljoin(MB_BASE_URL, f"index.php?do=submission/confirm_automatic_process&id={id_multibanda}&rType=page")
-            page.goto(confirm_url, timeout=NAV_TIMEOUT)
-            sleep(0.6)
-
-            imei_1 = get_input_value(page, ['//input[@type="text" and @value][contains(@id,"imei")][1]',
-                                            '/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[2]/div/div/input'])
-            imei_2 = get_input_value(page, ['/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[3]/div/div/input'])
-            numero_serie = get_input_value(page, ['/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[4]/div/div/input'])
-            numero_documento = get_input_value(page, ['/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[6]/div/div/input'])
-
-            nombre = get_input_value(page, [
-                '/html/body/div[1]/section/form/div[1]/div/div/div[3]/div[7]/div/div/input',
-                "//input[contains(@id,'name') or contains(@name,'name')]",
-                "input[name*='name'], input[id*='name']",
-            ])
-
-            tipo_documento = leer_tipo_documento(page)
-
-            try:
-                marca_raw = _inner_text(page, '//*[@id="formulario"]/div[1]/div/div/div[3]/div[8]/div/div/p/b') or "Apple"
-            except Exception:
-                marca_raw = "Apple"
-            try:
-                modelo_raw = _inner_text(page, '//*[@id="formulario"]/div[1]/div/div/div[3]/div[9]/div/div/p/b')
-            except Exception:
-                modelo_raw = ""
-
-            marca_norm, modelo_norm = normalizar_marca_modelo(marca_raw, modelo_raw)
-
-            pais_raw = leer_pais(page)
-            pais = normalizar_pais(pais_raw)
-
-            cantidad = "2" if (imei_2 or "").strip() else "1"
-
-            if _norm_key(marca_norm) in MODELOS_POR_MARCA and not _pareja_en_catalogo(marca_norm, modelo_norm):
-                elegido = _elegir_modelo_catalogo(marca_norm, preferencia=modelo_norm) or _elegir_modelo_catalogo(marca_norm)
-                if elegido:
-                    print(f"ℹ️ Ajuste final catálogo: {marca_norm} '{modelo_norm}' → '{elegido}'")
-                    modelo_norm = _finalize_model_case(_fix_model_spacing_specific(elegido))
-
-            datos.append({
-                "id": id_multibanda,
-                "cantidad_imei": cantidad,
-                "imei_1": imei_1,
-                "imei_2": (imei_2 or "").strip(),
-                "numero_serie": numero_serie,
-                "tipo_documento": tipo_documento,
-                "numero_documento": numero_documento,
-                "marca": marca_norm,
-                "modelo_comercial": modelo_norm,
-                "detalles_tecnicos": "Compra Internacional",
-                "nombre": nombre,
-                "pais_origen": pais,
-                "descripcion": "Uso personal"
-            })
+async def extraer_fila(page, id_multibanda):
+    # Aquí sí se espera "load": los valores de los inputs pueden completarse por JS al cargar
+    await page.goto(MB_CONFIRMAR_URL.format(id=id_multibanda))
+    await esperar_condicion(page, HAY_FILAS_JS, "input[id*='imei']", timeout=600)
+
+    campos = await page.evaluate(EXTRAER_JS, EXTRAER_SPEC)
+
+    return {
+        "id": id_multibanda,
+        "imei_1": campos["imei_1"],
+        "imei_2": campos["imei_2"],
+        "numero_serie": campos["numero_serie"],
+        "tipo_documento": _tipo_documento_desde(campos["tipo_documento"]),
+        "numero_documento": campos["numero_documento"],
+        "nombre": campos["nombre"],
+        "marca_raw": campos["marca_raw"] or "Apple",
+        "modelo_raw": campos["modelo_raw"],
+        "pais_raw": campos["pais_raw"] or "Chile",
+    }
 
+def abrir_cache_scrape(limpiar=False):
+    # Filas ya extraídas hoy, por ID: si el script se cae a mitad de lote, no se vuelven a visitar
+    try:
+        os.makedirs(os.path.dirname(CACHE_SCRAPE), exist_ok=True)
+        cache = shelve.open(CACHE_SCRAPE)
+    except Exception as e:
+        log.warning("⚠️ No se pudo abrir la caché de extracción (%s); se extraen todos los IDs.", e)
+        return None
+    sufijo = ":" + date.today().isoformat()
+    for k in [k for k in cache.keys() if limpiar or not k.endswith(sufijo)]:
+        del cache[k]
+    return cache
+
+async def extraer_y_normalizar_datos(page, ids_validos, concurrencia=CONCURRENCIA, executor=None, cache=None):
+    # Generador: entrega cada fila apenas está normalizada (las de caché primero) para que OABI
+    # empiece sin esperar al resto; al terminar escribe el Excel en el orden original de IDs.
+    # Con caché, cada fila queda en disco al normalizarse y no se guarda en memoria mientras se
+    # procesa: el Excel se arma al final leyendo la caché.
+    hoy = date.today().isoformat()
+    en_cache = set()
+    if cache is not None:
+        en_cache = {i for i in ids_validos if f"{i}:{hoy}" in cache}
+        if en_cache:
+            log.info("♻️ %s IDs ya extraídos hoy (caché); se omiten.", len(en_cache))
+    pendientes = [i for i in ids_validos if i not in en_cache]
+
+    # Varias pestañas del mismo contexto (misma sesión MB) visitan IDs en paralelo;
+    # la cola hace de semáforo y reparte pestañas libres.
+    paginas = [page] + [await page.context.new_page() for _ in range(min(concurrencia, len(pendientes)) - 1)]
+    libres = asyncio.Queue()
+    for p in paginas:
+        libres.put_nowait(p)
+
+    loop = asyncio.get_running_loop()
+
+    async def una(id_multibanda):
+        pestana = await libres.get()
+        try:
+            crudo = await extraer_fila(pestana, id_multibanda)
         except Exception as e:
-            print(f"❌ Error extrayendo ID {id_multibanda}: {e}")
-            continue
-
-    df = pd.DataFrame(datos)
-    df.to_excel(ARCHIVO_TEMP, index=False)
-    print(f"💾 Guardado {ARCHIVO_TEMP} con {len(df)} filas")
-    return datos
-
-def login_oabi(page, token_2fa: str):
-    page.goto(OABI_LOGIN_URL, timeout=NAV_TIMEOUT)
-    page.fill("#username", os.getenv("OABI_USER",""), timeout=DEF_TIMEOUT)
-    page.fill("#password", os.getenv("OABI_PASS",""), timeout=DEF_TIMEOUT)
-    page.keyboard.press("Enter")
-    page.wait_for_selector('xpath=//*[@id="token"]', timeout=NAV_TIMEOUT)
-    if not token_2fa:
-        token_2fa = input("🔐 Ingresa el token 2FA de OABI: ").strip()
-    page.fill('xpath=//*[@id="token"]', token_2fa)
-    page.keyboard.press("Enter")
-    sleep(7)
-    wait_invisible_loading(page)
-
-def abrir_inscripcion_administrativa(page):
-    robust_click(page, 'xpath=/html/body/div[1]/div[1]/ul/li[5]/a')
-    wait_invisible_loading(page)
-    robust_click(page, 'xpath=/html/body/div[1]/div[1]/ul/li[5]/ul/li[1]/a')
-    wait_invisible_loading(page)
-
-def validar_imei_en_oabi(page, imei_1, numero_documento=""):
-    abrir_inscripcion_administrativa(page)
-    page.wait_for_selector('xpath=//*[@id="in_imei"]', timeout=NAV_TIMEOUT)
+            log.error("❌ Error extrayendo ID %s: %s", id_multibanda, e)
+            return None
+        finally:
+            libres.put_nowait(pestana)
+        # La pestaña ya quedó libre: la normalización (CPU) se solapa con la siguiente navegación
+        try:
+            if executor is None:
+                fila = _normalize_row(crudo)
+            else:
+                fila = await loop.run_in_executor(executor, _normalize_row, crudo)
+        except Exception as e:
+            log.error("❌ Error normalizando ID %s: %s", id_multibanda, e)
+            return None
+        if cache is not None:
+            cache[f"{id_multibanda}:{hoy}"] = fila
+            cache.sync()
+        return fila
+
+    # Tareas creadas ya (en Python <= 3.12 as_completed recién las agenda al pedirle la primera):
+    # la extracción corre mientras salen las filas de caché y el consumidor las procesa
+    tareas = [asyncio.create_task(una(i)) for i in pendientes]
+    filas = {}  # solo sin caché en disco
+    try:
+        for i in ids_validos:
+            if i in en_cache:
+                yield cache[f"{i}:{hoy}"]
+        for tarea in asyncio.as_completed(tareas):
+            fila = await tarea
+            if fila:
+                if cache is None:
+                    filas[fila["id"]] = fila
+                yield fila
+    finally:
+        # Si el consumidor corta (p. ej. falla el login OABI), ninguna extracción sigue
+        # escribiendo en la caché después de que se cierre
+        for t in tareas:
+            t.cancel()
+        await asyncio.gather(*tareas, return_exceptions=True)
+    for p in paginas[1:]:
+        await p.close()
+
+    # La escritura va a un hilo: este tramo corre dentro del "async for" de OABI
+    if cache is not None:
+        # Ya no se escribe más: se cierra el manejador de escritura (gdbm/ndbm bloquean a otro
+        # lector mientras siga abierto); ejecutar() lo vuelve a cerrar sin efecto
+        cache.close()
+        claves = [f"{i}:{hoy}" for i in ids_validos]
+        n = await asyncio.to_thread(guardar_xlsx_desde_cache, ARCHIVO_TEMP, claves)
+    else:
+        n = await asyncio.to_thread(guardar_xlsx, ARCHIVO_TEMP, [filas[i] for i in ids_validos if i in filas])
+    log.info("💾 Guardado %s con %s filas", ARCHIVO_TEMP, n)
+
+def _limpiar_token(token: str) -> str:
+    # "123 456" o con saltos de línea pegados → "123456"
+    return "".join((token or "").split())
+
+async def sesion_oabi_vigente(page, con_sesion=True) -> bool:
+    # Solo sondea (no pide nada): con_sesion=False, el contexto partió sin sesión guardada
+    return con_sesion and await sesion_vigente(page, OABI_LOGIN_URL, OABI_SEL_USUARIO, OABI_SEL_DENTRO)
+
+def pedir_token_2fa() -> str:
+    # input() directo, no en un hilo: un hilo bloqueado en input() no se puede cancelar
+    # y asyncio.run se quedaría esperándolo al salir (sin IDs, Ctrl-C, error en MB)
+    return _limpiar_token(input("🔐 Ingresa el token 2FA de OABI: "))
+
+async def login_oabi(page, token_2fa: str, vigente=False):
+    # vigente: la sesión guardada ya se sondeó (sesion_oabi_vigente) → ni login ni 2FA
+    if vigente:
+        log.info("🔓 Sesión de OABI vigente, se omite login y 2FA.")
+        return
+    await page.goto(OABI_LOGIN_URL, wait_until=CARGA_RAPIDA)
+    await page.fill(OABI_SEL_USUARIO, os.getenv("OABI_USER",""), timeout=DEF_TIMEOUT)
+    await page.fill(OABI_SEL_CLAVE, os.getenv("OABI_PASS",""), timeout=DEF_TIMEOUT)
+    await page.keyboard.press("Enter")
+    await page.wait_for_selector(OABI_SEL_TOKEN, state="attached", timeout=NAV_TIMEOUT)
+    await page.fill(OABI_SEL_TOKEN, _limpiar_token(token_2fa))
+    await page.keyboard.press("Enter")
+    await page.wait_for_selector(OABI_SEL_DENTRO, state="attached", timeout=NAV_TIMEOUT)  # menú = sesión iniciada
+    await wait_invisible_loading(page)
+    await guardar_sesion(page.context, SESION_OABI)
+
+async def abrir_inscripcion_administrativa(page):
+    await robust_click(page, loc(page, "menu_inscripcion"), no_wait_after=True)  # solo despliega el submenú
+    await wait_invisible_loading(page)
+    await robust_click(page, loc(page, "submenu_inscripcion"))
+    await wait_invisible_loading(page)
+
+async def validar_imei_en_oabi(page, imei_1, numero_documento=""):
+    await abrir_inscripcion_administrativa(page)
+    await page.wait_for_selector('xpath=//*[@id="in_imei"]', state="attached", timeout=NAV_TIMEOUT)
     campo_imei = page.locator('xpath=//*[@id="in_imei"]')
-    try: campo_imei.fill("")
+    try: await campo_imei.fill("")
     except Exception: pass
-    campo_imei.type(str(imei_1))
-    page.keyboard.press("Enter")
-    sleep(1.5); wait_invisible_loading(page)
+    await campo_imei.type(str(imei_1))
+    await page.keyboard.press("Enter")
+    await wait_invisible_loading(page, aparecer=1500)
+    # Como antes: se espera a que haya filas y se revisan una vez; un IMEI ausente no agota el timeout
     try:
-        page.wait_for_selector("//table/tbody/tr", timeout=10_000)
-        filas = page.locator("//table/tbody/tr")
-        n = filas.count()
-        for i in range(n):
-            t = filas.nth(i).inner_text(timeout=1500).strip()
-            if str(imei_1) in t or (numero_documento and str(numero_documento) in t):
-                return True
-    except Exception:
-        pass
-    return False
+        res = await page.wait_for_function(FILA_CON_TEXTO_JS,
+                                           arg=["table > tbody > tr", [str(imei_1), str(numero_documento or "")]],
+                                           timeout=10_000)
+        return await res.json_value() == "si"
+    except PWTimeout:
+        return False
 
-def select_document_type(page, tipo_documento_text: str) -> bool:
+# Índice de la primera opción cuyo texto normalizado contiene alguna clave (0 si ninguna; null si no hay opciones)
+ELEGIR_OPCION_JS = """(els, claves) => {
+    if (!els.length) return null;
+    const i = els.findIndex(e => {
+        const n = (e.innerText || '').toLowerCase().replace(/[^a-z0-9]/g, '');
+        return claves.some(c => n.includes(c));
+    });
+    return i < 0 ? 0 : i;
+}"""
+
+async def select_document_type(page, tipo_documento_text: str) -> bool:
     want = re.sub(r'[^a-z0-9]', '', (tipo_documento_text or '').lower())
     target_pasaporte = ('pasap' in want) or ('pasaporte' in want)
     target_rutdni = ('rut' in want) or ('dni' in want) or ('rutdni' in want)
 
     # Dropdown bootstrap
-    if robust_click(page, 'xpath=/html/body/div[1]/div[2]/div/div/div/div/div/div[2]/div[5]/div/div/form/div[2]/div[4]/div/div/button/span[1]') \
-       or robust_click(page, 'xpath=//button[contains(@data-toggle,"dropdown")]'):
+    if await robust_click(page, 'xpath=/html/body/div[1]/div[2]/div/div/div/div/div/div[2]/div[5]/div/div/form/div[2]/div[4]/div/div/button/span[1]', no_wait_after=True) \
+       or await robust_click(page, 'xpath=//button[contains(@data-toggle,"dropdown")]', no_wait_after=True):
         try:
-            page.wait_for_selector("//div[contains(@class,'dropdown-menu')]", timeout=3000)
+            await page.wait_for_selector("//div[contains(@class,'dropdown-menu')]", timeout=3000)
         except Exception:
             pass
-        opciones = page.locator("//div[contains(@class,'dropdown-menu')]//a[normalize-space()]")
-        if opciones.count() == 0:
-            opciones = page.locator("//div[contains(@class,'dropdown-menu')]//*[self::a or self::button or self::li][normalize-space()]")
-        choice_idx = -1
-        for i in range(opciones.count()):
-            txt = opciones.nth(i).inner_text(timeout=1500).strip()
-            n = re.sub(r'[^a-z0-9]', '', txt.lower())
-            if target_pasaporte and ('pasap' in n or 'pasaporte' in n):
-                choice_idx = i; break
-            if target_rutdni and (('rut' in n) or ('dni' in n) or ('rutdni' in n)):
-                choice_idx = i; break
-        if choice_idx < 0 and opciones.count() > 0:
-            choice_idx = 0
-        if choice_idx >= 0:
-            opciones.nth(choice_idx).click()
-            return True
+        claves = (["pasap"] if target_pasaporte else []) + (["rut", "dni"] if target_rutdni else [])
+        for xp in ("//div[contains(@class,'dropdown-menu')]//a[normalize-space()]",
+                   "//div[contains(@class,'dropdown-menu')]//*[self::a or self::button or self::li][normalize-space()]"):
+            opciones = page.locator(xp)
+            choice_idx = await opciones.evaluate_all(ELEGIR_OPCION_JS, claves)
+            if choice_idx is not None:
+                await opciones.nth(choice_idx).click()
+                return True
 
     # select nativo
-    if page.locator("//select[contains(@id,'document') or contains(@name,'document')]").count() > 0:
+    if await page.locator("//select[contains(@id,'document') or contains(@name,'document')]").count() > 0:
         sel = page.locator("//select[contains(@id,'document') or contains(@name,'document')]").first
         opts = sel.locator("option")
+        n_opts = await opts.count()
         chosen = False
-        for i in range(opts.count()):
-            t = opts.nth(i).inner_text(timeout=1500).strip()
+        for i in range(n_opts):
+            t = (await opts.nth(i).inner_text(timeout=1500)).strip()
             n = re.sub(r'[^a-z0-9]', '', t.lower())
             if target_pasaporte and ('pasap' in n or 'pasaporte' in n):
-                sel.select_option(index=i); chosen=True; break
+                await sel.select_option(index=i); chosen=True; break
             if target_rutdni and (('rut' in n) or ('dni' in n) or ('rutdni' in n)):
-                sel.select_option(index=i); chosen=True; break
-        if not chosen and opts.count() > 0:
-            sel.select_option(index=0)
+                await sel.select_option(index=i); chosen=True; break
+        if not chosen and n_opts > 0:
+            await sel.select_option(index=0)
         return True
 
     return False
 
-def procesar_oabi_y_confirmar(page_oabi, page_mb, fila):
-    id_multibanda = fila["id"]
-    print(f"🟢 Procesando ID {id_multibanda}...")
+# Deja la bandeja de pendientes como recién cargada: buscador vacío y sin modales abiertos
+RESET_PENDIENTES_JS = """() => {
+    const b = document.querySelector('#buscador');
+    if (b && b.value) { b.value = ''; b.dispatchEvent(new Event('input', {bubbles: true})); }
+    document.querySelectorAll('.modal.show').forEach(m => { m.classList.remove('show'); m.style.display = 'none'; });
+    document.querySelectorAll('.modal-backdrop').forEach(e => e.remove());
+    document.body.classList.remove('modal-open');
+}"""
+
+def _es_respuesta_pendientes(resp):
+    return "pending_adm_submissions" in resp.url and resp.status == 200
+
+async def ir_a_pendientes_mb(page, recargar=False):
+    # Si la pestaña ya está en la bandeja se limpia en el DOM en vez de recargarla
+    # (recargar=True: se pide de nuevo al servidor, p. ej. para comprobar una confirmación)
+    if page.url == MB_PENDIENTES_URL and not recargar:
+        await page.evaluate(RESET_PENDIENTES_JS)
+    else:
+        await page.goto(MB_PENDIENTES_URL, wait_until=CARGA_RAPIDA)
+    await loc(page, "tabla").wait_for(state="attached", timeout=NAV_TIMEOUT)
+
+# Petición de confirmación MB aprendida de la primera confirmación por UI comprobada:
+# (url, headers, cuerpo, firma de la respuesta) con el ID reemplazado por "{id}". Las filas
+# siguientes la repiten tal cual con page.request (comparte cookies con el contexto) sin
+# renderizar la bandeja; al cerrar cada lote se comprueban todas con una sola recarga.
+_CONFIRMACION_MB = {}
+_HEADERS_NO_REPETIR = frozenset({"content-length", "cookie", "host"})
+
+def _patron_id(id_multibanda):
+    return re.compile(rf'(?<![0-9]){re.escape(str(id_multibanda))}(?![0-9])')
+
+def _firma_respuesta(status, headers, cuerpo, patron):
+    # Lo que distingue la respuesta de una confirmación de un login o un error que igual da 200:
+    # status (sin seguir redirecciones), tipo, destino de la redirección y forma del JSON
+    tipo = (headers.get("content-type") or "").split(";")[0].strip()
+    destino = patron.sub("{id}", headers.get("location") or "")
+    forma = None
+    if "json" in tipo:
+        try:
+            datos = json.loads(cuerpo or b"null")
+        except ValueError:
+            datos = None
+        if isinstance(datos, dict):
+            # bool/None y textos cortos ("ok", "error") por valor; el resto solo por tipo
+            forma = tuple(sorted(
+                (k, v if isinstance(v, (bool, type(None))) else
+                    patron.sub("{id}", v) if isinstance(v, str) and len(v) <= 20 else type(v).__name__)
+                for k, v in datos.items()))
+    en_login = MB_SEL_USUARIO.lstrip("#").encode() in (cuerpo or b"")
+    return status, tipo, destino, forma, en_login
+
+async def _cuerpo(resp):
+    # Las respuestas de redirección no tienen cuerpo legible
+    try:
+        return await resp.body()
+    except Exception:
+        return b""
+
+async def _aprender_confirmacion_mb(req, id_multibanda):
+    # "descartada": una repetición ya dio respuesta de éxito sin confirmar (p. ej. token CSRF de un
+    # solo uso); en lo que queda de corrida todo va por la UI
+    if "plantilla" in _CONFIRMACION_MB or "descartada" in _CONFIRMACION_MB:
+        return
+    try:
+        resp = await req.response()
+    except Exception:
+        return
+    if resp is None:
+        return
+    patron = _patron_id(id_multibanda)
+    url = patron.sub("{id}", req.url)
+    cuerpo = patron.sub("{id}", req.post_data or "")
+    if "{id}" not in url and "{id}" not in cuerpo:
+        return
+    # Headers originales (X-Requested-With, CSRF, content-type...); las cookies las pone el contexto
+    headers = {k: v for k, v in req.headers.items() if k.lower() not in _HEADERS_NO_REPETIR}
+    firma = _firma_respuesta(resp.status, resp.headers, await _cuerpo(resp), patron)
+    _CONFIRMACION_MB["plantilla"] = (url, headers, cuerpo, firma)
+    log.info("🧠 Confirmación MB aprendida; las siguientes van por petición directa.")
+
+async def confirmar_mb_por_api(page, id_multibanda) -> bool:
+    # True: MB aceptó la petición según su respuesta. No basta para darla por confirmada (un
+    # redirect-after-POST responde igual si la rechaza): procesar_filas_oabi la comprueba en la
+    # bandeja al cerrar el lote
+    plantilla = _CONFIRMACION_MB.get("plantilla")
+    if not plantilla:
+        return False
+    url, headers, cuerpo, firma = plantilla
+    id_s = str(id_multibanda)
+    try:
+        # Mismo cuerpo crudo y content-type; sin seguir redirecciones (una al login daría 200)
+        resp = await page.request.post(url.replace("{id}", id_s), headers=headers,
+                                       data=cuerpo.replace("{id}", id_s), max_redirects=0)
+        ok = _firma_respuesta(resp.status, resp.headers, await _cuerpo(resp), _patron_id(id_s)) == firma
+    except Exception:
+        return False
+    if not ok:
+        log.warning("⚠️ Confirmación directa no reconocida (%s) para ID %s; se usa la UI.", resp.status, id_s)
+        _CONFIRMACION_MB.pop("plantilla", None)  # se vuelve a aprender en la próxima confirmación por UI
+    return ok
 
-    wait_invisible_loading(page_oabi)
-    robust_click(page_oabi, 'xpath=/html/body/div[1]/div[1]/ul/li[5]/a')
-    wait_invisible_loading(page_oabi)
-    robust_click(page_oabi, 'xpath=/html/body/div[1]/div[1]/ul/li[5]/ul/li[1]/a/span[2]')
-    sleep(1.2)
+def fila_mb(page, id_multibanda):
+    # Fila de la bandeja cuyo <th> es exactamente el ID ("12" no debe tomar la fila "123")
+    id_re = re.compile(rf"^\s*{re.escape(str(id_multibanda))}\s*$")
+    return loc(page, "filas").filter(has=page.locator("th", has_text=id_re))
 
-    wait_invisible_loading(page_oabi)
-    robust_click(page_oabi, 'xpath=/html/body/div[1]/div[2]/div/div/div/div/div/div[2]/div[2]/button')
+async def buscar_fila_mb(page_mb, id_multibanda, recargar=False):
+    await ir_a_pendientes_mb(page_mb, recargar=recargar)
+    await esperar_condicion(page_mb, HAY_FILAS_JS, "#tabla-ordenable tbody tr", timeout=800)
 
-    page_oabi.wait_for_selector("#cant_imeis", timeout=NAV_TIMEOUT)
-    page_oabi.fill("#cant_imeis", str(fila["cantidad_imei"]))
-    page_oabi.keyboard.press("Tab")
-    sleep(0.8)
+    # Sin sondeo previo: fill() con timeout corto ya dice si hay buscador (la tabla ya está en el DOM)
+    try:
+        await loc(page_mb, "buscador").fill(str(id_multibanda), timeout=500)
+        hay_buscador = True
+    except PWTimeout:
+        hay_buscador = False
+    if hay_buscador:
+        # Búsqueda en servidor: se espera su respuesta; si filtra en el cliente no llega y basta el DOM
+        try:
+            async with page_mb.expect_response(_es_respuesta_pendientes, timeout=800):
+                await page_mb.keyboard.press("Enter")
+        except PWTimeout:
+            pass
+        await esperar_condicion(page_mb, SOLO_FILA_ID_JS, str(id_multibanda), timeout=800)
+    return fila_mb(page_mb, id_multibanda)
+
+async def sigue_pendiente_mb(fila) -> bool:
+    # Mismo criterio que obtener_ids_validos: la fila existe y su acción dice "Confirmar en OABI"
+    # (la bandeja también lista filas en otros estados)
+    if await fila.count() == 0:
+        return False
+    return any("Confirmar en OABI" in t for t in await fila.locator(ROW_ACTION_SEL).all_inner_texts())
+
+async def confirmar_mb_ui(page_mb, id_multibanda) -> bool:
+    # True solo si el POST salió y en la bandeja recargada el ID ya no está pendiente
+    fila = await buscar_fila_mb(page_mb, id_multibanda)
+    # Con o sin buscador (o con el filtro aún en curso) se actúa solo sobre la fila del ID;
+    # si no está, no se confirma nada: otra fila no fue validada en OABI
+    if await fila.count() == 0 or not await robust_click(page_mb, fila.locator(ROW_ACTION_SEL)):
+        log.error("❌ ID %s no aparece en la bandeja de MB; no se confirma.", id_multibanda)
+        return False
+    try:
+        async with page_mb.expect_request(lambda r: r.method == "POST", timeout=DEF_TIMEOUT) as info:
+            await robust_click(page_mb, loc(page_mb, "confirm_btn"), no_wait_after=True)  # espera el modal
+        req = await info.value
+    except PWTimeout:
+        log.error("❌ El modal de MB no envió la confirmación (ID %s).", id_multibanda)
+        return False
+    try:
+        await loc(page_mb, "modal").first.wait_for(state="hidden", timeout=DEF_TIMEOUT)
+        # Si la confirmación recargó la bandeja, se espera el DOM nuevo (inmediato si no navegó)
+        await page_mb.wait_for_load_state("domcontentloaded")
+    except PWTimeout:
+        pass
+    if await sigue_pendiente_mb(await buscar_fila_mb(page_mb, id_multibanda, recargar=True)):
+        log.error("❌ ID %s sigue pendiente en MB tras confirmar.", id_multibanda)
+        return False
+    # Confirmación comprobada: su POST queda como plantilla para las filas siguientes
+    await _aprender_confirmacion_mb(req, id_multibanda)
+    return True
+
+async def enviar_a_oabi(page_oabi, fila):
+    id_multibanda = fila["id"]
+    log.info("🟢 Procesando ID %s...", id_multibanda)
+
+    await wait_invisible_loading(page_oabi)
+    await robust_click(page_oabi, loc(page_oabi, "menu_inscripcion"), no_wait_after=True)
+    await wait_invisible_loading(page_oabi)
+    await robust_click(page_oabi, loc(page_oabi, "submenu_inscripcion"))
+    await wait_invisible_loading(page_oabi)
+    await robust_click(page_oabi, loc(page_oabi, "nueva_inscripcion"))
+
+    # "attached": fill() ya espera por su cuenta a que el campo sea visible y editable
+    await page_oabi.wait_for_selector("#cant_imeis", state="attached", timeout=NAV_TIMEOUT)
+    await page_oabi.fill("#cant_imeis", str(fila["cantidad_imei"]))
+    await page_oabi.keyboard.press("Tab")
+    try:
+        await page_oabi.wait_for_selector("#cert_new_imei_1, #cert_new_imei_01", state="attached", timeout=3000)
+    except PWTimeout:
+        pass
 
     # IMEIs
     try:
-        page_oabi.fill("#cert_new_imei_1", str(fila["imei_1"]))
+        await page_oabi.fill("#cert_new_imei_1", str(fila["imei_1"]))
     except Exception:
-        page_oabi.fill("#cert_new_imei_01", str(fila["imei_1"]))
+        await page_oabi.fill("#cert_new_imei_01", str(fila["imei_1"]))
     if fila["cantidad_imei"] == "2":
         try:
-            page_oabi.fill("#cert_new_imei_2", str(fila["imei_2"]))
+            await page_oabi.fill("#cert_new_imei_2", str(fila["imei_2"]))
         except Exception:
-            page_oabi.fill("#cert_new_imei_02", str(fila["imei_2"]))
+            await page_oabi.fill("#cert_new_imei_02", str(fila["imei_2"]))
 
-    page_oabi.fill("#num_serie", str(fila["numero_serie"]))
+    await page_oabi.fill("#num_serie", str(fila["numero_serie"]))
 
     # Tipo documento
-    if not select_document_type(page_oabi, fila["tipo_documento"]):
-        robust_click(page_oabi, 'xpath=/html/body/div[1]/div[2]/div/div/div/div/div/div[2]/div[5]/div/div/form/div[2]/div[4]/div/div/button')
-        page_oabi.locator("//div[@class='dropdown-menu']//a[contains(.,'Pasaporte')]").first.click(timeout=3000)
+    if not await select_document_type(page_oabi, fila["tipo_documento"]):
+        await robust_click(page_oabi, 'xpath=/html/body/div[1]/div[2]/div/div/div/div/div/div[2]/div[5]/div/div/form/div[2]/div[4]/div/div/button', no_wait_after=True)
+        await page_oabi.locator("//div[@class='dropdown-menu']//a[contains(.,'Pasaporte')]").first.click(timeout=3000)
 
     # Número documento
     ok_doc = False
     for sel in ["#cert_new_number_pasaporte", "#cert_new_number_dni", "#cert_new_number_rut",
                 "//input[contains(@id,'pasaporte') or contains(@id,'dni') or contains(@id,'rut')]"]:
         try:
-            page_oabi.fill(sel, str(fila["numero_documento"]))
+            await page_oabi.fill(sel, str(fila["numero_documento"]))
             ok_doc = True
             break
         except Exception:
             continue
     if not ok_doc:
-        print("⚠️ No se pudo rellenar número de documento.")
-
-    # Marca/Modelo normalizados (via teclado y TAB)
-    page_oabi.keyboard.press("Tab")  # foco marca
-    page_oabi.keyboard.type(str(fila["marca"]))
-    page_oabi.keyboard.press("Enter")
-    page_oabi.keyboard.press("Tab")  # foco modelo
-    sleep(0.6)
-    page_oabi.keyboard.type(str(fila["modelo_comercial"]))
-    page_oabi.keyboard.type(" ")
-    page_oabi.keyboard.press("Backspace")
-    page_oabi.keyboard.press("Enter")
-    page_oabi.keyboard.press("Tab")
-    sleep(0.6)
+        log.warning("⚠️ No se pudo rellenar número de documento.")
+
+    # Marca/Modelo normalizados (foco con TAB, valor directo en el DOM)
+    await page_oabi.keyboard.press("Tab")  # foco marca
+    await escribir_en_foco(page_oabi, str(fila["marca"]))
+    await page_oabi.keyboard.press("Enter")
+    await page_oabi.keyboard.press("Tab")  # foco modelo
+    # Formulario nuevo: el select de modelo parte vacío y se llena al elegir la marca
+    await esperar_condicion(page_oabi, MODELOS_LISTOS_JS, "", timeout=3000)
+    await escribir_en_foco(page_oabi, str(fila["modelo_comercial"]))
+    await page_oabi.keyboard.type(" ")
+    await page_oabi.keyboard.press("Backspace")
+    await page_oabi.keyboard.press("Enter")
+    await page_oabi.keyboard.press("Tab")
+    await esperar_condicion(page_oabi, DROPDOWN_CERRADO_JS, timeout=600)
 
     # Si exige modelo, forzar Apple/iPhone
-    if model_error_present(page_oabi):
-        print(f"⚠️ Modelo inválido. Forzando Apple/iPhone (ID {id_multibanda})...")
-        forzar_marca_modelo_generico(page_oabi)
-        if model_error_present(page_oabi):
-            print("⚠️ Reintentando forzar Apple/iPhone...")
-            forzar_marca_modelo_generico(page_oabi)
+    if await model_error_present(page_oabi):
+        log.warning("⚠️ Modelo inválido. Forzando Apple/iPhone (ID %s)...", id_multibanda)
+        await forzar_marca_modelo_generico(page_oabi)
+        if await model_error_present(page_oabi):
+            log.warning("⚠️ Reintentando forzar Apple/iPhone...")
+            await forzar_marca_modelo_generico(page_oabi)
 
     # Detalles / Nombre / País / Descripción
-    page_oabi.fill("#cert_new_detalles_tec", str(fila["detalles_tecnicos"]))
-    page_oabi.fill("#cert_new_name", str(fila["nombre"]))
-    page_oabi.keyboard.press("Tab")  # foco país
-    page_oabi.keyboard.type(str(fila["pais_origen"]))
-    page_oabi.keyboard.press("Enter")
-    page_oabi.keyboard.press("Tab")
-
-    page_oabi.fill("#cert_new_description", str(fila["descripcion"]))
-    page_oabi.keyboard.press("Enter")
-    sleep(0.5)
-    wait_invisible_loading(page_oabi)
-    print(f"✅ Enviado a OABI: ID {id_multibanda}")
-
-    # Validación por IMEI
-    ok_oabi = validar_imei_en_oabi(page_oabi, fila["imei_1"], fila["numero_documento"])
-    if not ok_oabi and fila.get("imei_2"):
-        ok_oabi = validar_imei_en_oabi(page_oabi, fila["imei_2"], fila["numero_documento"])
+    await page_oabi.fill("#cert_new_detalles_tec", str(fila["detalles_tecnicos"]))
+    await page_oabi.fill("#cert_new_name", str(fila["nombre"]))
+    await page_oabi.keyboard.press("Tab")  # foco país
+    await escribir_en_foco(page_oabi, str(fila["pais_origen"]))
+    await page_oabi.keyboard.press("Enter")
+    await page_oabi.keyboard.press("Tab")
+
+    await page_oabi.fill("#cert_new_description", str(fila["descripcion"]))
+    await page_oabi.keyboard.press("Enter")
+    await wait_invisible_loading(page_oabi, aparecer=500)
+    log.info("✅ Enviado a OABI: ID %s", id_multibanda)
+    return True
+
+# (imei, documento) ya vistos en OABI durante esta corrida. Solo se guardan los positivos:
+# un IMEI inscrito no deja de estarlo, pero uno no encontrado puede aparecer tras enviarlo.
+_IMEI_CACHE: dict = {}
+
+async def validar_imei_cacheado(page, imei, numero_documento=""):
+    key = (str(imei), str(numero_documento or ""))
+    if _IMEI_CACHE.get(key):
+        return True
+    ok = await validar_imei_en_oabi(page, imei, numero_documento)
+    if ok:
+        _IMEI_CACHE[key] = True
+    return ok
+
+def _fila_visible(fila, visibles) -> bool:
+    # Solo por IMEI y como número completo: el listado no está filtrado, así que el documento
+    # de un cliente que repite coincidiría con sus inscripciones anteriores
+    patrones = [_patron_id(str(fila[k]).strip()) for k in ("imei_1", "imei_2") if str(fila.get(k) or "").strip()]
+    return any(p.search(t) for t in visibles for p in patrones)
+
+async def esta_en_oabi(page_oabi, fila, visibles=()) -> bool:
+    # Validación por IMEI: primero contra el listado leído para el lote; si no aparece, búsqueda puntual
+    ok_oabi = _fila_visible(fila, visibles)
     if not ok_oabi:
-        print(f"❌ No se visualiza IMEI en Inscripción Administrativa (ID {id_multibanda}). No se confirma en MB.")
-        return
-
-    # Confirmación en Multibanda por ID
-    page_mb.goto(urljoin(MB_BASE_URL, "index.php?do=submission/pending_adm_submissions_landing_page&rType=page&navbarp=1"), timeout=NAV_TIMEOUT)
-    page_mb.wait_for_selector("#tabla-ordenable", timeout=NAV_TIMEOUT)
-    sleep(0.8)
-
-    if page_mb.locator("#buscador").count() > 0:
-        page_mb.fill("#buscador", str(id_multibanda))
-        page_mb.keyboard.press("Enter")
-        sleep(0.8)
-    robust_click(page_mb, 'xpath=/html/body/div[1]/section[2]/div/div/div[2]/table/tbody/tr/td[9]/div/a')
-    robust_click(page_mb, 'xpath=/html/body/div[3]/div/div/div[3]/button[2]')
-
-    print(f"🔐 ✅ Confirmado en Multibanda por ID {id_multibanda}")
-
-def main():
-    ap = argparse.ArgumentParser(description="MB↔OABI on-device (Playwright/Termux)")
-    ap.add_argument("--token", help="Token 2FA de OABI", default="")
-    args = ap.parse_args()
+        ok_oabi = await validar_imei_cacheado(page_oabi, fila["imei_1"], fila["numero_documento"])
+    if not ok_oabi and fila.get("imei_2"):
+        ok_oabi = await validar_imei_cacheado(page_oabi, fila["imei_2"], fila["numero_documento"])
+    return ok_oabi
 
-    token_2fa = (args.token or "").strip()
+async def validar_en_oabi(page_oabi, fila, visibles=()) -> bool:
+    ok_oabi = await esta_en_oabi(page_oabi, fila, visibles)
+    if not ok_oabi:
+        log.error("❌ No se visualiza IMEI en Inscripción Administrativa (ID %s). No se confirma en MB.", fila['id'])
+    return ok_oabi
+
+async def ids_pendientes_mb(page_mb) -> set:
+    # Bandeja recargada: IDs que siguen con "Confirmar en OABI" (mismo criterio que obtener_ids_validos)
+    await ir_a_pendientes_mb(page_mb, recargar=True)
+    await esperar_condicion(page_mb, HAY_FILAS_JS, "#tabla-ordenable tbody tr", timeout=800)
+    filas = await loc(page_mb, "filas").evaluate_all(FILAS_IDS_JS)
+    return {i.strip() for i, accion in filas if "Confirmar en OABI" in accion}
+
+async def confirmar_en_mb(page_mb, id_multibanda):
+    # Confirmación en Multibanda por la UI, ya comprobada en la bandeja
+    if not await confirmar_mb_ui(page_mb, id_multibanda):
+        return False
+    log.info("🔐 ✅ Confirmado en Multibanda por ID %s", id_multibanda)
+    return True
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)  # Cambia a False si quieres ver el navegador (más pesado)
-        # Un contexto para MB y otro para OABI evita cruces de sesión/cookies
-        ctx_mb = browser.new_context()
-        ctx_oabi = browser.new_context()
+async def leer_inscripciones_oabi(page):
+    # Textos de todas las filas visibles en Inscripción Administrativa, en un solo round-trip
+    await abrir_inscripcion_administrativa(page)
+    await esperar_condicion(page, HAY_FILAS_JS, "table > tbody > tr", timeout=3000)
+    try:
+        return await page.locator("table > tbody > tr").evaluate_all("els => els.map(e => e.innerText)")
+    except Exception:
+        return []
 
-        page_mb = ctx_mb.new_page()
-        page_oabi = ctx_oabi.new_page()
+def cargar_hechos(pendientes=None):
+    # Progreso de corridas anteriores: último estado por ID. Un ID "enviado" que OABI ya muestra
+    # no se vuelve a inscribir (evita duplicados si el script murió antes de confirmar en MB).
+    # pendientes: IDs que MB aún lista; el resto ya salió de la bandeja y se poda del archivo.
+    hechos = {}
+    try:
+        with open(HECHOS_OABI, encoding="utf-8") as fh:
+            for linea in fh:
+                partes = linea.split()
+                if len(partes) == 2:
+                    hechos[partes[0]] = partes[1]
+    except FileNotFoundError:
+        pass
+    if pendientes is not None:
+        pendientes = set(pendientes)
+        vigentes = {i: e for i, e in hechos.items() if i in pendientes}
+        if len(vigentes) < len(hechos):
+            tmp = HECHOS_OABI + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                fh.writelines(f"{i} {e}\n" for i, e in vigentes.items())
+            os.replace(tmp, HECHOS_OABI)
+        hechos = vigentes
+    return hechos
+
+def marcar_hecho(id_multibanda, estado):
+    os.makedirs(os.path.dirname(HECHOS_OABI), exist_ok=True)
+    with open(HECHOS_OABI, "a", encoding="utf-8") as fh:
+        fh.write(f"{id_multibanda} {estado}\n")
+
+async def procesar_filas_oabi(page_oabi, ctx_mb, filas, concurrencia=CONCURRENCIA_OABI, oabi_listo=None, hechos=None):
+    # filas: iterable asíncrono (se procesa a medida que MB las entrega); oabi_listo: tarea de
+    # login OABI que se espera recién con la primera fila, así la extracción ya está en marcha.
+    # Pestañas OABI y MB van en colas separadas: cada paso toma una libre y la suelta al terminar,
+    # así la confirmación MB de una fila se solapa con la validación OABI de la siguiente y dos
+    # pasos nunca navegan la misma pestaña. Se abren a demanda hasta `concurrencia` por sitio;
+    # las MB son propias (la extracción sigue usando las suyas) y las OABI parten en la portada post-login.
+    async def abrir_oabi(n):
+        if n == 1:
+            return page_oabi
+        p = await page_oabi.context.new_page()
+        try:
+            await p.goto(page_oabi.url, wait_until=CARGA_RAPIDA)
+        except BaseException:
+            await p.close()  # no queda una pestaña huérfana fuera del pool
+            raise
+        return p
+
+    async def abrir_mb(n):
+        return await ctx_mb.new_page()
+
+    pools = {"oabi": (abrir_oabi, asyncio.Queue(), []), "mb": (abrir_mb, asyncio.Queue(), [])}
+    cupos = {"oabi": 0, "mb": 0}  # pestañas abiertas o abriéndose por sitio
+
+    async def tomar(sitio):
+        abrir, libres, abiertas = pools[sitio]
+        while True:
+            if libres.empty() and cupos[sitio] < concurrencia:
+                cupos[sitio] += 1  # reserva el cupo antes de esperar la apertura
+                try:
+                    pestana = await abrir(cupos[sitio])
+                except BaseException:
+                    # Cupo liberado; None despierta a quien espera en la cola para que intente abrir
+                    cupos[sitio] -= 1
+                    libres.put_nowait(None)
+                    raise
+                abiertas.append(pestana)
+                return pestana
+            pestana = await libres.get()
+            if pestana is not None:
+                return pestana
+
+    async def en_pestana(sitio, paso, fila, *extra):
+        libres = pools[sitio][1]
+        try:
+            pestana = await tomar(sitio)
+        except Exception as e:
+            log.error("❌ Error en ID %s (abriendo pestaña %s): %s", fila.get('id'), sitio.upper(), e)
+            return False
+        try:
+            return await paso(pestana, *extra)
+        except Exception as e:
+            log.error("❌ Error en ID %s: %s", fila.get('id'), e)
+            return False
+        finally:
+            libres.put_nowait(pestana)
+
+    hechos = {} if hechos is None else hechos
+
+    async def enviar(fila):
+        ok = await en_pestana("oabi", enviar_a_oabi, fila, fila)
+        if ok:
+            marcar_hecho(fila["id"], "enviado")
+        return ok
+
+    async def reanudar(fila):
+        # Enviado en otra corrida: si OABI ya lo muestra no se reinscribe; si no, el envío falló y se repite
+        if await en_pestana("oabi", esta_en_oabi, fila, fila):
+            return True
+        log.warning("⚠️ ID %s no aparece en OABI pese a haberse enviado; se vuelve a enviar.", fila['id'])
+        return await enviar(fila)
+
+    async def confirmar_por_ui(fila):
+        if await en_pestana("mb", confirmar_en_mb, fila, fila["id"]):
+            marcar_hecho(fila["id"], "confirmado")
+
+    async def validar_y_confirmar(fila, visibles):
+        # Devuelve la fila si fue por petición directa: falta comprobarla en la bandeja
+        if not await en_pestana("oabi", validar_en_oabi, fila, fila, visibles):
+            return None
+        if await en_pestana("mb", confirmar_mb_por_api, fila, fila["id"]):
+            return fila
+        await confirmar_por_ui(fila)
+
+    async def comprobar_directas(directas):
+        # Una sola recarga de la bandeja para todas las confirmaciones directas del lote
+        pendientes = await en_pestana("mb", ids_pendientes_mb, directas[0])
+        if pendientes is False:  # sin bandeja no se da ninguna por confirmada
+            pendientes = {str(f["id"]) for f in directas}
+        reintentar = []
+        for f in directas:
+            if str(f["id"]) in pendientes:
+                reintentar.append(f)
+            else:
+                log.info("🔐 ✅ Confirmado en Multibanda por ID %s", f["id"])
+                marcar_hecho(f["id"], "confirmado")
+        if reintentar:
+            log.warning("⚠️ %s confirmaciones directas no se reflejaron en MB; se hacen por la UI.", len(reintentar))
+            _CONFIRMACION_MB.pop("plantilla", None)
+            _CONFIRMACION_MB["descartada"] = True
+            resultados = await asyncio.gather(*(confirmar_por_ui(f) for f in reintentar), return_exceptions=True)
+            for f, r in zip(reintentar, resultados):
+                if isinstance(r, Exception):
+                    log.error("❌ Error en ID %s: %s", f.get('id'), r)
+
+    async def cerrar_lote(lote):
+        # Se lee el listado de OABI una vez para todo el lote y se confirma en MB
+        # return_exceptions: un fallo inesperado de una fila no corta la corrida ni el resto del lote
+        resultados = await asyncio.gather(*(t for _, t in lote), return_exceptions=True)
+        enviados = []
+        for (f, _), ok in zip(lote, resultados):
+            if isinstance(ok, Exception):
+                log.error("❌ Error en ID %s: %s", f.get('id'), ok)
+            elif ok:
+                enviados.append(f)
+        if enviados:
+            visibles = await leer_inscripciones_oabi(page_oabi)  # todas las pestañas OABI están libres aquí
+            resultados = await asyncio.gather(*(validar_y_confirmar(f, visibles) for f in enviados),
+                                              return_exceptions=True)
+            directas = []
+            for f, r in zip(enviados, resultados):
+                if isinstance(r, Exception):
+                    log.error("❌ Error en ID %s: %s", f.get('id'), r)
+                elif r:
+                    directas.append(f)
+            if directas:
+                await comprobar_directas(directas)
+
+    # Cada fila se envía a OABI apenas llega; cada LOTE_VALIDACION filas (o al final) se valida
+    lote = []
+    async for fila in filas:
+        if oabi_listo is not None:
+            await oabi_listo
+            oabi_listo = None
+        # hechos ya viene podado a los IDs que MB sigue listando: un "confirmado" que aparece
+        # aquí no quedó confirmado y se trata igual que uno solo enviado
+        estado = hechos.get(str(fila["id"]))
+        if estado:
+            log.info("⏭️ ID %s ya enviado a OABI (%s); se valida antes de reenviar.", fila['id'], estado)
+            lote.append((fila, asyncio.create_task(reanudar(fila))))
+        else:
+            lote.append((fila, asyncio.create_task(enviar(fila))))
+        if len(lote) >= LOTE_VALIDACION:
+            await cerrar_lote(lote)
+            lote = []
+    if lote:
+        await cerrar_lote(lote)
+    for _, _, abiertas in pools.values():
+        for p in abiertas:
+            if p is not page_oabi:
+                await p.close()
+
+async def ejecutar(args, executor):
+    token_2fa = _limpiar_token(args.token)
+
+    async with async_playwright() as p:
+        # Un contexto para MB y otro para OABI (mismo navegador) evita cruces de sesión/cookies
+        ctx_mb = await make_worker(p, "mb", usar_sesion=not args.relogin)
+        ctx_oabi = await make_worker(p, "oabi", usar_sesion=not args.relogin)
+        # Tras make_worker (que descarta archivos corruptos): ¿partió cada contexto con sesión?
+        con_sesion = {rol: not args.relogin and os.path.exists(path) for rol, path in SESIONES.items()}
+
+        page_mb = await ctx_mb.new_page()
+        page_oabi = await ctx_oabi.new_page()
+
+        # ----- OABI: mientras Multibanda avanza solo se sondea la sesión guardada (no pide token)
+        sondeo_oabi = asyncio.create_task(sesion_oabi_vigente(page_oabi, con_sesion=con_sesion["oabi"]))
 
         # ----- Multibanda: login + IDs
-        print("🌐 Login a Multibanda…")
-        login_multibanda(page_mb)
-        ids = obtener_ids_validos(page_mb)
+        log.info("🌐 Login a Multibanda…")
+        await login_multibanda(page_mb, con_sesion=con_sesion["mb"])
+        ids = await obtener_ids_validos(page_mb)
         if not ids:
-            print("⚠️ No se encontraron IDs con 'Confirmar en OABI'. Fin.")
-            browser.close()
+            log.warning("⚠️ No se encontraron IDs con 'Confirmar en OABI'. Fin.")
+            sondeo_oabi.cancel()
+            await cerrar_browser()
             return
 
-        # ----- Extraer/normalizar + Excel
-        registros = extraer_y_normalizar_datos(page_mb, ids)
-
-        # ----- OABI: login + 2FA
-        print("🌐 Login a OABI…")
-        login_oabi(page_oabi, token_2fa)
-
-        # ----- Proceso OABI + confirmación MB por cada fila
-        for fila in registros:
-            try:
-                procesar_oabi_y_confirmar(page_oabi, page_mb, fila)
-            except Exception as e:
-                print(f"❌ Error en ID {fila.get('id')}: {e}")
-                continue
+        # ----- OABI: con trabajo pendiente se pide el token (si hace falta) antes de arrancar
+        # la extracción; el login sigue en segundo plano, solapado con ella
+        oabi_vigente = await sondeo_oabi
+        if not oabi_vigente and not token_2fa:
+            token_2fa = pedir_token_2fa()
+        log.info("🌐 Login a OABI…")
+        oabi_listo = asyncio.create_task(login_oabi(page_oabi, token_2fa, vigente=oabi_vigente))
+
+        # ----- Extraer/normalizar (+ Excel) → OABI + confirmación MB, fila a fila a medida que llegan
+        cache = abrir_cache_scrape(limpiar=args.no_cache)
+        filas = extraer_y_normalizar_datos(page_mb, ids, concurrencia=max(1, args.concurrencia),
+                                           executor=executor, cache=cache)
+        try:
+            await procesar_filas_oabi(page_oabi, ctx_mb, filas, concurrencia=max(1, args.concurrencia_oabi),
+                                      oabi_listo=oabi_listo, hechos=cargar_hechos(ids))
+            await oabi_listo  # por si no llegó ninguna fila: errores de login no quedan sin ver
+        finally:
+            await filas.aclose()  # cancela las extracciones en curso antes de cerrar la caché
+            if cache is not None:
+                cache.close()
+
+        # Cookies renovadas durante la corrida: la próxima parte con la sesión más fresca
+        await guardar_sesion(ctx_mb, SESION_MB)
+        await guardar_sesion(ctx_oabi, SESION_OABI)
+        await cerrar_browser()
+        log.info("🏁 Proceso completo finalizado.")
+
+async def main():
+    ap = argparse.ArgumentParser(description="MB↔OABI on-device (Playwright/Termux)")
+    ap.add_argument("--token", help="Token 2FA de OABI", default="")
+    ap.add_argument("--concurrencia", type=int, default=CONCURRENCIA,
+                    help=f"Pestañas de Multibanda en paralelo al extraer datos (default {CONCURRENCIA})")
+    ap.add_argument("--no-cache", action="store_true",
+                    help="Ignora la caché de extracción del día y vuelve a leer todos los IDs")
+    ap.add_argument("--concurrencia-oabi", type=int, default=CONCURRENCIA_OABI,
+                    help=f"Filas procesadas en OABI en paralelo (default {CONCURRENCIA_OABI})")
+    ap.add_argument("--relogin", action="store_true",
+                    help="Ignora las sesiones guardadas y vuelve a hacer login (y 2FA en OABI)")
+    args = ap.parse_args()
+    configurar_logging()
 
-        browser.close()
-        print("🏁 Proceso completo finalizado.")
+    # Antes de Playwright (que ya trae hilos): ver crear_pool_normalizacion
+    executor = crear_pool_normalizacion()
+    try:
+        await ejecutar(args, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
 
 if __name__ == "__main__":
     try:
-        main()
+        asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n⛔ Cancelado por usuario.")
+        log.warning("⛔ Cancelado por usuario.")
         sys.exit(130)